@@ -1,4 +1,4 @@
 from .reconstruct import *
 from .decode import *
 from .mps import *
-
+from .ulp import *
@@ -1,22 +1,27 @@
 import itertools
+import functools
 import os
 import pickle
 import cv2
 import json
 import Imath
 import OpenEXR
-import joblib
 import scipy
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
-from scipy.optimize import least_squares
 from utils import *
 from process import *
-from scipy.ndimage.filters import gaussian_filter
-import scipy.ndimage.morphology as morph
-from skimage import measure
-from skimage import filters
+
+# plt, PCA, least_squares and joblib come lazily from utils, the remaining heavy imports are deferred the same way
+ndimage = LazyModule("scipy.ndimage")
+morph = LazyModule("scipy.ndimage.morphology")
+gaussian_filter = LazyObject("scipy.ndimage.filters", "gaussian_filter")
+measure = LazyModule("skimage.measure")
+filters = LazyModule("skimage.filters")
+
+try:
+    import numba  # Optional: fused multi-threaded decode kernels (NumPy fallback otherwise)
+except ImportError:
+    numba = None
 
 
 def gray_to_bin(num):
@@ -28,24 +33,85 @@ def gray_to_bin(num):
     return num
 
 
-def get_single_bit_mask(filename, inverted_filename, undistort=None, plot=False, **kw):
-    image = load_openexr(filename, make_gray=True)
-    inverted = load_openexr(inverted_filename, make_gray=True)
+if numba is not None:
+    # Fused compare -> shift -> OR of one (pattern, inverted) pair into the gray code image, without bool temporaries
+    @numba.njit(parallel=True, cache=True)
+    def _fold_pair_jit(code, image, inverted, bit):
+        b = np.uint16(1 << bit)
+        for r in numba.prange(code.shape[0]):
+            for c in range(code.shape[1]):
+                if image[r, c] > inverted[r, c]:
+                    code[r, c] |= b
+
+    # Single pass over both code images: mask -> gray to binary (in place) -> validity
+    @numba.njit(parallel=True, cache=True)
+    def _finish_codes_jit(h, v, mask):
+        valid = np.zeros(h.shape, dtype=np.bool_)
+        for r in numba.prange(h.shape[0]):
+            for c in range(h.shape[1]):
+                if mask[r, c]:
+                    hb, vb = h[r, c], v[r, c]
+                    hb ^= hb >> 8
+                    hb ^= hb >> 4
+                    hb ^= hb >> 2
+                    hb ^= hb >> 1
+                    vb ^= vb >> 8
+                    vb ^= vb >> 4
+                    vb ^= vb >> 2
+                    vb ^= vb >> 1
+                    h[r, c], v[r, c] = hb, vb
+                    valid[r, c] = hb > 0 and vb > 0
+                else:
+                    h[r, c], v[r, c] = 0, 0
+        return valid
+
+
+# stride > 1 keeps every stride-th pixel of each frame (preview mode). half=True keeps HALF scans in float16, which is
+# enough for comparing the pair (cv2.remap can not undistort float16, so it is ignored with undistort)
+def load_pair(filename, inverted_filename, undistort=None, stride=1, half=False, **kw):
+    half = half and undistort is None
+    image = load_openexr(filename, make_gray=True, single_channel=True, half=half)
+    inverted = load_openexr(inverted_filename, make_gray=True, single_channel=True, half=half)
     print("Loaded", filename)
 
+    if stride > 1:
+        image = np.ascontiguousarray(image[::stride, ::stride])
+        inverted = np.ascontiguousarray(inverted[::stride, ::stride])
+
     if undistort is not None:
-        image = cv2.undistort(image, undistort["mtx"], undistort["dist"], newCameraMatrix=undistort["new_mtx"])
-        inverted = cv2.undistort(inverted, undistort["mtx"], undistort["dist"], newCameraMatrix=undistort["new_mtx"])
+        image = undistort_image(image, undistort)
+        inverted = undistort_image(inverted, undistort)
+
+    return image, inverted
+
+
+# Bit masks travel between processes packed 8 pixels per byte (see pack_bit_mask)
+def get_single_bit_mask(filename, inverted_filename, undistort=None, plot=False, pack=False, **kw):
+    image, inverted = load_pair(filename, inverted_filename, undistort=undistort, half=True, **kw)
 
     bit_mask = image > inverted
 
     if plot:
         plot_image(1 * bit_mask, filename + " - Bit Mask")
 
-    return bit_mask
+    return pack_bit_mask(bit_mask) if pack else bit_mask
+
+
+# Pack a bool image along rows (1 bit per pixel) to cut pickling traffic from worker processes by 8x
+def pack_bit_mask(bit_mask):
+    return np.packbits(bit_mask, axis=-1), bit_mask.shape[-1]
+
 
+def unpack_bit_mask(packed, out=None):
+    bits, width = packed
+    bits = np.unpackbits(bits, axis=-1, count=width).view(bool)
+    if out is not None:
+        out[...] = bits
+        return out
+    return bits
 
-def get_all_bit_masks(template, inverted_template, ids=None, undistort=None, **kw):
+
+def get_all_bit_masks(template, inverted_template, ids=None, undistort=None, ram_budget=None, **kw):
     if ids is not None:
         filenames = [template % id for id in ids]
         inverted_filenames = [inverted_template % id for id in ids]
@@ -53,42 +119,217 @@ def get_all_bit_masks(template, inverted_template, ids=None, undistort=None, **k
         filenames, inverted_filenames = template, inverted_template
 
     jobs = [joblib.delayed(get_single_bit_mask)
-            (filename, inverted_filename, undistort=undistort, plot=False, **kw)
+            (filename, inverted_filename, undistort=undistort, plot=False, pack=True, **kw)
             for filename, inverted_filename in zip(filenames, inverted_filenames)]
 
-    return np.array(joblib.Parallel(verbose=15, n_jobs=-1, batch_size=1, pre_dispatch="all")(jobs))
+    packed = run_parallel(jobs, task_bytes([filenames[0], inverted_filenames[0]]), ram_budget)
+
+    # Unpack straight into a preallocated stack instead of copying a list of full bool planes with np.array()
+    bit_masks = np.empty((len(packed), packed[0][0].shape[0], packed[0][1]), dtype=bool)
+    for i in range(len(packed)):
+        unpack_bit_mask(packed[i], out=bit_masks[i])
+        packed[i] = None
+
+    return bit_masks
+
 
+# OR a single bit plane into a (gray) code image in place
+def fold_bit_mask(code, bit_mask, bit):
+    np.bitwise_or(code, np.left_shift(bit_mask, bit, dtype=code.dtype), out=code)
+    return code
 
-def decode_single(data_path, symmetric=True, out_dir="decoded", mask_sigma=3, mask_iter=6, crop=None, offset=-150,
-                  undistort=None, file_pattern="img_%02d.exr", load_depth=False, group=False, save=True, plot=False, threshold=0, save_figures=True, verbose=False, **kw):
+
+# Streaming alternative to get_all_bit_masks: consume one (pattern, inverted) pair at a time and fold it straight
+# into a uint16 gray code image. Peak memory is 1 + prefetch_depth pairs of frames plus the code image instead of all
+# bit planes. With n_jobs != 1 pairs are thresholded in worker processes which ship back packed bit masks only
+def accumulate_codes(template, inverted_template, ids=None, undistort=None, n_jobs=1, jit=True, ram_budget=None, prefetch_depth=1, **kw):
+    if ids is not None:
+        filenames = [template % id for id in ids]
+        inverted_filenames = [inverted_template % id for id in ids]
+    else:
+        filenames, inverted_filenames = template, inverted_template
+
+    if n_jobs != 1:
+        jobs = [joblib.delayed(get_single_bit_mask)
+                (filename, inverted_filename, undistort=undistort, plot=False, pack=True, **kw)
+                for filename, inverted_filename in zip(filenames, inverted_filenames)]
+
+        packed = run_parallel(jobs, task_bytes([filenames[0], inverted_filenames[0]]), ram_budget, n_jobs=n_jobs)
+
+        code = np.zeros((packed[0][0].shape[0], packed[0][1]), dtype=np.uint16)
+        for bit in range(len(packed)):
+            fold_bit_mask(code, unpack_bit_mask(packed[bit]), bit)
+            packed[bit] = None
+
+        return code
+
+    # The next prefetch_depth pairs are loaded on background threads while the current one is folded in. The numba
+    # kernel is compiled for float32, so pairs are only read as HALF for the NumPy fold
+    jit = jit and numba is not None
+    pairs = prefetch(load_pair, zip(filenames, inverted_filenames), depth=prefetch_depth, undistort=undistort,
+                     half=not jit, **kw)
+
+    code = None
+    for bit, (image, inverted) in enumerate(pairs):
+        if code is None:
+            code = np.zeros(image.shape, dtype=np.uint16)
+
+        if jit:
+            _fold_pair_jit(code, image, inverted, bit)
+        else:
+            fold_bit_mask(code, image > inverted, bit)
+
+    return code
+
+
+# Compact (CSR) storage of the pixels of all groups: pixels of group i are the row-major flat indices
+# indices[offsets[i]:offsets[i + 1]]. Indexing returns (k, 2) arrays of (row, col) coords, just like the
+# list of region coords that used to be pickled to group_rcs.pkl, but the arrays themselves can be memory-mapped
+class PixelGroups:
+    def __init__(self, offsets, indices, width):
+        self.offsets, self.indices, self.width = offsets, indices, width
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, i):
+        idx = np.asarray(self.indices[self.offsets[i]:self.offsets[i + 1]], dtype=np.int64)
+        return np.stack(np.divmod(idx, self.width), axis=1)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @staticmethod
+    def from_coords(group_rcs, width):
+        counts = np.array([rcs.shape[0] for rcs in group_rcs], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        rcs = np.concatenate(group_rcs, axis=0) if len(group_rcs) else np.zeros((0, 2), dtype=np.int64)
+        return PixelGroups(offsets, (rcs[:, 0] * width + rcs[:, 1]).astype(np.uint32), width)
+
+    def save(self, path):
+        np.save(path + "/group_offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+        np.save(path + "/group_pixels.npy", np.asarray(self.indices, dtype=np.uint32))
+
+    @staticmethod
+    def load(path, width, mmap_mode="r"):
+        return PixelGroups(np.load(path + "/group_offsets.npy", mmap_mode=mmap_mode),
+                           np.load(path + "/group_pixels.npy", mmap_mode=mmap_mode), width)
+
+
+# Original per-region loop over measure.regionprops (slow for millions of groups, kept for reference)
+def extract_groups_regionprops(labels, h, v, symmetric=True, verbose=False):
+    group_cam_xy, group_proj_xy, group_counts, group_rcs = [], [], [], []
+    for i, region in enumerate(measure.regionprops(labels)):
+        if i % 10000 == 0 and verbose:
+            print("Group", i)
+        # if i > 20000:
+        #     break
+
+        if region.label > 0:
+            group_counts.append(region.coords.shape[0])
+            group_rcs.append(region.coords)
+            group_cam_xy.append(region.centroid[::-1])
+            r0, c0 = region.coords[0, :]
+            xy = np.array([v[r0, c0], h[r0, c0]], dtype=np.int64)
+            if symmetric:
+                xy -= [1024 - 1920 // 2, 1024 - 1080 // 2]
+            group_proj_xy.append(xy)
+
+    return np.array(group_cam_xy), np.array(group_proj_xy), np.array(group_counts), group_rcs
+
+
+# Vectorized equivalent of extract_groups_regionprops. Pixels are stably sorted by label so that each group keeps
+# raster order (as regionprops coords do), then counts and centroids come from bincount and codes from the first pixel
+def extract_groups(labels, h, v, symmetric=True):
+    rr, cc = np.nonzero(labels)
+    ids = labels[rr, cc]
+    order = np.argsort(ids, kind="stable")
+    rr, cc, ids = rr[order], cc[order], ids[order]
+
+    counts = np.bincount(ids)
+    present = np.nonzero(counts[1:])[0] + 1
+    group_counts = counts[present]
+    group_cam_xy = np.stack([np.bincount(ids, weights=cc)[present] / group_counts,
+                             np.bincount(ids, weights=rr)[present] / group_counts], axis=1)
+
+    offsets = np.concatenate([[0], np.cumsum(group_counts)])
+    r0, c0 = rr[offsets[:-1]], cc[offsets[:-1]]
+    group_proj_xy = np.stack([v[r0, c0], h[r0, c0]], axis=1).astype(np.int64)
+    if symmetric:
+        group_proj_xy -= [1024 - 1920 // 2, 1024 - 1080 // 2]
+
+    group_rcs = PixelGroups(offsets, (rr * labels.shape[1] + cc).astype(np.uint32), labels.shape[1])
+
+    return group_cam_xy, group_proj_xy, group_counts, group_rcs
+
+
+def decode_single(data_path, symmetric=True, out_dir=None, mask_sigma=3, mask_iter=6, crop=None, offset=-150,
+                  undistort=None, file_pattern="img_%02d.exr", load_depth=False, group=False, save=True, plot=False, threshold=0, save_figures=True, verbose=False, stream=False, group_method="vectorized", dense=False, undistort_mode="images", jit=True, preview=None, white=None, **kw):
+    # white: the white frame if already loaded (symmetric patterns), as load_openexr(..., single_channel=True,
+    # load_depth=load_depth) returns it
+    # preview=4 (or 8, ...) decodes every preview-th pixel of every preview-th row through the same code path into
+    # "decoded_preview". Pixel based parameters and the undistort intrinsics are rescaled to the strided view and the
+    # stride is saved to stride.txt, so that reconstruct_single(preview=True) can rescale the camera calibration
+    stride = preview or 1
+    if out_dir is None:
+        out_dir = "decoded_preview" if preview else "decoded"
+    if stride > 1:
+        mask_sigma, mask_iter = mask_sigma / stride, max(1, mask_iter // stride)
+        crop, offset = crop // stride if crop else crop, offset // stride
+        if undistort is not None:
+            undistort = scale_calibration(undistort, 1.0 / stride)
+        kw["stride"] = stride
+
+    # undistort_mode="points" thresholds in raw sensor space and leaves undistortion of the decoded correspondences
+    # (and group centroids) to reconstruct_single, instead of warping all input frames with the undistort calibration
+    if undistort_mode == "points":
+        undistorted, undistort = ("points" if undistort is not None else str(False)), None
+    else:
+        undistorted = str(undistort is not None)
+
+    # stream=True folds bit planes into uint16 code images as they are loaded instead of keeping all of them in memory
+    # jit=True uses the fused Numba kernels for the streaming path when numba is installed
+    fused = stream and jit and numba is not None
+    get_bits = functools.partial(accumulate_codes, jit=jit) if stream else get_all_bit_masks
 
     if symmetric:
         all_names = [file_pattern % i for i in range(46)]
         v_names, v_inv_names = reversed(all_names[2:24:2]), reversed(all_names[3:24:2])
         h_names, h_inv_names = reversed(all_names[24::2]), reversed(all_names[25::2])
 
-        h_masks = get_all_bit_masks([data_path + n for n in h_names], [data_path + n for n in h_inv_names], undistort=undistort, **kw)
-        v_masks = get_all_bit_masks([data_path + n for n in v_names], [data_path + n for n in v_inv_names], undistort=undistort, **kw)
+        h_masks = get_bits([data_path + n for n in h_names], [data_path + n for n in h_inv_names], undistort=undistort, **kw)
+        v_masks = get_bits([data_path + n for n in v_names], [data_path + n for n in v_inv_names], undistort=undistort, **kw)
         bit_masks = h_masks, v_masks
     else:
-        bit_masks = [get_all_bit_masks(data_path + dir + "_%d.exr", data_path + dir + "_%d_inv.exr",
-                                       ids=range(11), undistort=undistort, **kw)
+        bit_masks = [get_bits(data_path + dir + "_%d.exr", data_path + dir + "_%d_inv.exr",
+                              ids=range(11), undistort=undistort, **kw)
                      for dir in ["horizontal", "vertical"]]
     if verbose:
-        print("Bit masks:", bit_masks[0].shape, bit_masks[0].size / 1024**2, "MB")
+        print("Bit masks:" if not stream else "Codes:", bit_masks[0].shape, bit_masks[0].nbytes / 1024**2, "MB")
 
     if symmetric:
-        if load_depth:
-            white, depth_gt = load_openexr(data_path + "/" + file_pattern%0, make_gray=True, load_depth=load_depth) #TODO switch to proper path handling
+        if white is not None:
+            white, depth_gt = white if load_depth else (white, None)
+        elif load_depth:
+            white, depth_gt = load_openexr(data_path + "/" + file_pattern%0, make_gray=True, load_depth=load_depth, single_channel=True) #TODO switch to proper path handling
         else:
-            white = load_openexr(data_path + "/" + file_pattern%0, make_gray=True, load_depth=load_depth) #TODO switch to proper path handling
+            white = load_openexr(data_path + "/" + file_pattern%0, make_gray=True, load_depth=load_depth, single_channel=True) #TODO switch to proper path handling
             depth_gt = None
-        blank = load_openexr(data_path + "/" + file_pattern%1, make_gray=True)
+        blank = load_openexr(data_path + "/" + file_pattern%1, make_gray=True, single_channel=True)
     else:
-        white = load_openexr(data_path + "/white.exr", make_gray=True)
-        blank = load_openexr(data_path + "/blank.exr", make_gray=True)
+        white = load_openexr(data_path + "/white.exr", make_gray=True, single_channel=True)
+        blank = load_openexr(data_path + "/blank.exr", make_gray=True, single_channel=True)
         depth_gt = None
 
+    if stride > 1:
+        white, blank = white[::stride, ::stride], blank[::stride, ::stride]
+        if depth_gt is not None:
+            depth_gt = depth_gt[::stride, ::stride]
+
     clean = white - blank
     if crop:
         clean[:, :crop] = 0  # crop to the left of the rotating stage
@@ -97,7 +338,7 @@ def decode_single(data_path, symmetric=True, out_dir="decoded", mask_sigma=3, ma
     thr_otsu, mask = cv2.threshold(ldr, threshold, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
     print("Thresholds:", thr_ldr, thr_otsu)
 
-    struct = scipy.ndimage.generate_binary_structure(2, 1)
+    struct = ndimage.generate_binary_structure(2, 1)
     mask = morph.binary_erosion(mask, struct, mask_iter)
 
     # Old: filters away parts of the image where projected pattern got blurred too much
@@ -106,24 +347,34 @@ def decode_single(data_path, symmetric=True, out_dir="decoded", mask_sigma=3, ma
     # d_mask = diff > 0.07 * np.max(diff)
     # mask &= morph.binary_erosion(d_mask, struct, 2)
 
-    idx = np.nonzero(~mask)
-    bit_masks[0][:, idx[0], idx[1]] = 0
-    bit_masks[1][:, idx[0], idx[1]] = 0
+    if fused:
+        h, v = bit_masks
+        valid = _finish_codes_jit(h, v, mask.astype(np.bool_))
+    elif stream:
+        h, v = bit_masks
+        h[~mask] = 0
+        v[~mask] = 0
+    else:
+        idx = np.nonzero(~mask)
+        bit_masks[0][:, idx[0], idx[1]] = 0
+        bit_masks[1][:, idx[0], idx[1]] = 0
 
-    h, v = np.zeros_like(mask, dtype=np.int), np.zeros_like(mask, dtype=np.int)
+        h, v = np.zeros_like(mask, dtype=np.int), np.zeros_like(mask, dtype=np.int)
 
-    for i in range(11):
-        h = np.bitwise_or(h, np.left_shift(bit_masks[0][i, ...].astype(np.int), i))
-        v = np.bitwise_or(v, np.left_shift(bit_masks[1][i, ...].astype(np.int), i))
+        for i in range(11):
+            h = np.bitwise_or(h, np.left_shift(bit_masks[0][i, ...].astype(np.int), i))
+            v = np.bitwise_or(v, np.left_shift(bit_masks[1][i, ...].astype(np.int), i))
 
-    h, v = gray_to_bin(h), gray_to_bin(v)
+    if not fused:
+        h, v = gray_to_bin(h), gray_to_bin(v)
+        valid = (h > 0) & (v > 0)
 
     if verbose:
         print("Horizontal Range:", [np.min(h), np.max(h)])
         print("Vertical Range:", [np.min(v), np.max(v)])
 
-    r, c = np.nonzero((h > 0) & (v > 0))
-    p_r, p_c = h[r, c].ravel(), v[r, c].ravel()
+    r, c = np.nonzero(valid)
+    p_r, p_c = h[r, c].ravel().astype(np.int64), v[r, c].ravel().astype(np.int64)
 
     if symmetric:
         p_r -= 1024 - 1080 // 2
@@ -138,44 +389,38 @@ def decode_single(data_path, symmetric=True, out_dir="decoded", mask_sigma=3, ma
     if group:
         labels = measure.label(img, background=0, connectivity=2)
 
-        group_cam_xy, group_proj_xy, group_counts, group_rcs = [], [], [], []
-        for i, region in enumerate(measure.regionprops(labels)):
-            if i % 10000 == 0 and verbose:
-                print("Group", i)
-            # if i > 20000:
-            #     break
-
-            if region.label > 0:
-                group_counts.append(region.coords.shape[0])
-                group_rcs.append(region.coords)
-                group_cam_xy.append(region.centroid[::-1])
-                r0, c0 = region.coords[0, :]
-                xy = np.array([v[r0, c0], h[r0, c0]])
-                if symmetric:
-                    xy -= [1024 - 1920 // 2, 1024 - 1080 // 2]
-                group_proj_xy.append(xy)
-
-        group_cam_xy, group_proj_xy, group_counts = np.array(group_cam_xy), np.array(group_proj_xy), np.array(group_counts)
+        if group_method == "regionprops":
+            group_cam_xy, group_proj_xy, group_counts, group_rcs = extract_groups_regionprops(labels, h, v, symmetric, verbose=verbose)
+        else:
+            group_cam_xy, group_proj_xy, group_counts, group_rcs = extract_groups(labels, h, v, symmetric)
         print("Groups:", group_cam_xy.shape)
 
     if save:
         save_path = data_path + "/" + out_dir + "/"
         ensure_exists(save_path)
 
+        saved, saved_groups = as_saved_dtypes((cam_xy, proj_xy, mask), (group_cam_xy, group_proj_xy, group_counts, group_rcs) if group else None)
         if load_depth:
             np.save(save_path + "depth_gt.npy", depth_gt)
-        np.save(save_path + "camera_xy.npy", cam_xy.astype(np.uint16))
-        np.save(save_path + "projector_xy.npy", proj_xy.astype(np.uint16))
+        if dense:
+            save_dense_correspondences(save_path, cam_xy, proj_xy, mask.shape)
+        else:
+            np.save(save_path + "camera_xy.npy", saved[0])
+            np.save(save_path + "projector_xy.npy", saved[1])
+            remove_layout(save_path, dense=True)
         np.save(save_path + "mask.npy", mask)
         with open(save_path + "undistorted.txt", "w") as f:
-            f.write(str(undistort is not None))
+            f.write(undistorted)
+        with open(save_path + "stride.txt", "w") as f:
+            f.write(str(stride))
 
         if group:
-            np.save(save_path + "group_cam_xy.npy", group_cam_xy.astype(np.float32))
-            np.save(save_path + "group_proj_xy.npy", group_proj_xy.astype(np.uint16))
-            np.save(save_path + "group_counts.npy", group_counts.astype(np.uint32))
-            with open(save_path + "group_rcs.pkl", "wb") as f:
-                pickle.dump(group_rcs, f)
+            np.save(save_path + "group_cam_xy.npy", saved_groups[0])
+            np.save(save_path + "group_proj_xy.npy", saved_groups[1])
+            np.save(save_path + "group_counts.npy", saved_groups[2])
+            if not isinstance(group_rcs, PixelGroups):
+                group_rcs = PixelGroups.from_coords(group_rcs, mask.shape[1])
+            group_rcs.save(save_path)
     else:
         save_path = None
 
@@ -206,28 +451,135 @@ def decode_single(data_path, symmetric=True, out_dir="decoded", mask_sigma=3, ma
     return (cam_xy, proj_xy, mask), (group_cam_xy, group_proj_xy, group_counts, group_rcs) if group else None
 
 
+# Dense correspondence maps: a (height, width, 2) uint16 image of (projector x, projector y) per camera pixel.
+# The top bit of the x channel flags valid pixels, which leaves 15 bits for fixed point codes with frac_bits
+# fractional bits (0 for gray codes, up to 4 for sub-pixel MPS columns at 1920 projector columns).
+# Saved as a plain .npy so that rows / tiles can be sliced from a memory map without loading the whole scan
+DENSE_VALID = 1 << 15
+
+
+# Fixed point codes of proj_xy and which of them fit into the 15 bits of the dense format
+def encode_dense(proj_xy, frac_bits=0):
+    q = np.round(np.asarray(proj_xy) * (1 << frac_bits)).astype(np.int64)
+    valid = np.all((q >= 0) & (q < DENSE_VALID), axis=-1)  # out of range codes can not be represented
+    return q, valid
+
+
+# Removes the files of the dense (or the sparse) correspondence layout from path. load_decoded picks the layout by
+# which files exist, so saving one layout has to remove what an earlier decode of the other one left there
+def remove_layout(path, dense):
+    for name in ["correspondences.npy", "correspondences.json"] if dense else ["camera_xy.npy", "projector_xy.npy"]:
+        if os.path.exists(path + "/" + name):
+            os.remove(path + "/" + name)
+
+
+# Empty (all invalid) dense map on disk, returned as a writable memory map. Can also be filled band by band, e.g. by
+# worker processes re-opening it with np.load(..., mmap_mode="r+")
+def create_dense_correspondences(path, shape, frac_bits=0):
+    remove_layout(path, dense=False)
+    with open(path + "/correspondences.json", "w") as f:
+        json.dump({"shape": list(shape), "frac_bits": frac_bits, "valid_bit": 15}, f, indent=4)
+
+    return np.lib.format.open_memmap(path + "/correspondences.npy", mode="w+", dtype=np.uint16, shape=(shape[0], shape[1], 2))
+
+
+def save_dense_correspondences(path, cam_xy, proj_xy, shape, frac_bits=0):
+    q, valid = encode_dense(proj_xy, frac_bits)
+    cam_xy, q = cam_xy[valid], q[valid]
+
+    corr = create_dense_correspondences(path, shape, frac_bits)
+    corr[cam_xy[:, 1], cam_xy[:, 0], 0] = q[:, 0] | DENSE_VALID
+    corr[cam_xy[:, 1], cam_xy[:, 0], 1] = q[:, 1]
+    corr.flush()
+    del corr
+
+    if np.any(~valid):
+        print("Dropped %d correspondences outside of the dense code range" % np.count_nonzero(~valid))
+
+
+# Returns the raw uint16 map (memory-mapped by default) and its frac_bits. rows=(r0, r1) selects a band of rows
+def load_dense_correspondences(path, rows=None, mmap_mode="r"):
+    with open(path + "/correspondences.json", "r") as f:
+        frac_bits = json.load(f)["frac_bits"]
+
+    corr = np.load(path + "/correspondences.npy", mmap_mode=mmap_mode)
+    if rows is not None:
+        corr = corr[rows[0]:rows[1]]
+
+    return corr, frac_bits
+
+
+# Convert (a band of) a dense map back to coordinate lists. Codes are uint16 for integer maps and float32 otherwise
+def dense_to_sparse(corr, frac_bits=0, row_offset=0):
+    r, c = np.nonzero(corr[..., 0] & DENSE_VALID)
+    proj_xy = np.stack([corr[r, c, 0] & (DENSE_VALID - 1), corr[r, c, 1]], axis=1)
+    if frac_bits > 0:
+        proj_xy = proj_xy.astype(np.float32) / (1 << frac_bits)
+
+    return np.stack([c, r + row_offset], axis=1).astype(np.uint16), proj_xy
+
+
+# Tiled access to a dense map: yields (first row, cam_xy, proj_xy) for consecutive bands of chunk_rows rows
+def iter_dense_correspondences(path, chunk_rows=512):
+    corr, frac_bits = load_dense_correspondences(path)
+
+    for r0 in range(0, corr.shape[0], chunk_rows):
+        cam_xy, proj_xy = dense_to_sparse(np.asarray(corr[r0:r0 + chunk_rows]), frac_bits, row_offset=r0)
+        yield r0, cam_xy, proj_xy
+
+
+# decode_single results (all, groups) with the dtypes they are saved with, so that in memory results match the ones
+# loaded from the decoded folder
+def as_saved_dtypes(all, groups):
+    cam_xy, proj_xy, mask = all
+    all = cam_xy.astype(np.uint16), proj_xy.astype(np.uint16), mask
+    if groups:
+        group_cam_xy, group_proj_xy, group_counts, group_rcs = groups
+        groups = group_cam_xy.astype(np.float32), group_proj_xy.astype(np.uint16), group_counts.astype(np.uint32), group_rcs
+
+    return all, groups
+
+
+# Group pixels are returned as a lazy, memory-mapped PixelGroups view (or a list of coords for old group_rcs.pkl)
 def load_decoded(path):
-    all = np.load(path + "/camera_xy.npy"), np.load(path + "/projector_xy.npy"), np.load(path + "/mask.npy")
+    if os.path.exists(path + "/camera_xy.npy"):
+        all = np.load(path + "/camera_xy.npy"), np.load(path + "/projector_xy.npy"), np.load(path + "/mask.npy")
+    else:
+        corr, frac_bits = load_dense_correspondences(path)
+        cam_xy, proj_xy = dense_to_sparse(corr, frac_bits)
+        all = cam_xy, proj_xy, np.load(path + "/mask.npy")
 
     if os.path.exists(path + "/group_cam_xy.npy"):
         groups = [np.load(path + "/group_cam_xy.npy"), np.load(path + "/group_proj_xy.npy"),
                   np.load(path + "/group_counts.npy"), None]
-        with open(path + "/group_rcs.pkl", "rb") as f:
-            groups[3] = pickle.load(f)
+        if os.path.exists(path + "/group_offsets.npy"):
+            groups[3] = PixelGroups.load(path, all[2].shape[1])
+        else:
+            with open(path + "/group_rcs.pkl", "rb") as f:
+                groups[3] = pickle.load(f)
     else:
         groups = None
 
     return all, groups
 
 
-def decode_many(path_template, suffix="gray/", **kw):
+# With n_jobs != 1 positions are decoded in parallel, as many at a time as fit into ram_budget (see run_parallel).
+# Per position memory is estimated from the first frame: ~4x its decoded size with stream=True, ~8x otherwise
+def decode_many(path_template, suffix="gray/", n_jobs=1, ram_budget=None, **kw):
     paths = glob.glob(path_template)
     print("Found %d directories:" % len(paths), paths)
 
+    if n_jobs != 1 and len(paths) > 0:
+        frames = sorted(glob.glob(paths[0] + "/" + suffix + "*.exr"))[:1]
+        per_task = task_bytes(frames, overhead=4 if kw.get("stream", False) else 8) if frames else None
+
+        jobs = [joblib.delayed(decode_single)(path + "/" + suffix, ram_budget=ram_budget, **kw) for path in paths]
+        return run_parallel(jobs, per_task, ram_budget, n_jobs=n_jobs)
+
     for i, path in enumerate(paths):
         print("Decoding %d:" % i, path + "/" + suffix)
         plt.close("all")
-        decode_single(path + "/" + suffix, **kw)
+        decode_single(path + "/" + suffix, ram_budget=ram_budget, **kw)
 
 
 if __name__ == "__main__":
@@ -2,19 +2,38 @@ import numpy as np
 import scipy.io
 import os
 import cv2
-import scipy.signal
+from utils import prefetch, load_openexr, ensure_exists, run_parallel, joblib, LazyModule
+from decode import DENSE_VALID, encode_dense, create_dense_correspondences
+
+try:
+    import numba  # Optional: compiled candidate search for phase_unwrap_hierarchical (NumPy fallback otherwise)
+except ImportError:
+    numba = None
+
+signal = LazyModule("scipy.signal")  # Slow to import, only needed once decoding starts
 
 #medfiltParam = 5 # The computed correspondence map is median filtered to mitigate noise. These are the median filter parameters. Usual values are between [1 1] to [7 7], depending on image noise levels, number of images used, and the frequencies.
 #Use smaller values of these parameters for low noise levels, large number of input images, and low frequencies. For example, if the average frequency is 64 pixels, and 15 frequencies are used, use medFiltParam = [1 1]. 
 #On the other hand, if the average frequency is 16 pixels, and 5 frequencies are used, use medFiltParam = [7 7].
 
-def decode_mps(images_path, pattern_path, prefix="img", suffix=".png", cam=[2048, 2048], pro=[1920, 1080], medfilt_param=5):
-    frequency_vec = scipy.io.loadmat(pattern_path + '/freqData.mat')["frequencyVec"][0] #vector containing the projected frequencies (periods in pixels)
-    num_frequency = len(frequency_vec)
+# 8-bit PNGs are scaled to [0, 1], HDR captures (.exr) are loaded as gray as they are (float16 if stored as HALF, the
+# frames are copied into float32 / float64 matrices anyway). rows=(r0, r1) returns a band of rows, which only reads
+# those scanlines from EXRs
+def load_mps_frame(img_name, rows=None):
+    if img_name.lower().endswith(".exr"):
+        return load_openexr(img_name, make_gray=True, single_channel=True, half=True, rows=rows)
 
-    # Making the measurement matrix M (see paper for definition)
+    img = cv2.imread(img_name)   # reads an image in the BGR format
+    if rows is not None:
+        img = img[rows[0]:rows[1]]
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype("float64")
+    return img / 255
+
+
+# Making the measurement matrix M (see paper for definition)
+def make_measurement_mat(num_frequency):
     M = np.zeros((num_frequency+2, num_frequency+2))
-    
+
     # Filling the first three rows -- correpsonding to the first frequency
     M[0,:3] = [1, np.cos(2*np.pi*0/3), -np.sin(2*np.pi*0/3)]
     M[1,:3] = [1, np.cos(2*np.pi*1/3), -np.sin(2*np.pi*1/3)]
@@ -29,15 +48,21 @@ def decode_mps(images_path, pattern_path, prefix="img", suffix=".png", cam=[2048
         line.extend([0.0]*(num_frequency-f-1))
         M[f+2, :] = line
 
+    return M
+
+
+def decode_mps(images_path, pattern_path, prefix="img", suffix=".png", cam=[2048, 2048], pro=[1920, 1080], medfilt_param=5, prefetch_depth=2, unwrap="brute"):
+    frequency_vec = scipy.io.loadmat(pattern_path + '/freqData.mat')["frequencyVec"][0] #vector containing the projected frequencies (periods in pixels)
+    num_frequency = len(frequency_vec)
+
+    M = make_measurement_mat(num_frequency)
+
     #%%%%%%%%%%%% Making the observation matrix (captured images) %%%%%%%%%%%%%
     R = np.zeros((num_frequency+2, cam[0]*cam[1]))
 
-    # Filling the observation matrix (image intensities)
-    for i in range(0, num_frequency+2):
-        img_name = images_path + '/' + prefix + "_%03i"%i + suffix
-        img = cv2.imread(img_name)   # reads an image in the BGR format
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype("float64")
-        img = img / 255
+    # Filling the observation matrix (image intensities). Following frames are read on background threads meanwhile
+    img_names = [(images_path + '/' + prefix + "_%03i"%i + suffix,) for i in range(0, num_frequency+2)]
+    for i, img in enumerate(prefetch(load_mps_frame, img_names, depth=prefetch_depth)):
         R[i,:]  = img.T.reshape(-1)
         
     #%%%%%%%%%%%%%%%%%% Solving the linear system %%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -57,13 +82,90 @@ def decode_mps(images_path, pattern_path, prefix="img", suffix=".png", cam=[2048
 
     #%%%%%%%%%%%%%% Converting the CosSinMat into column indices %%%%%%%%%%%%%%
     # IC            -- correspondence map (corresponding projector column (sub-pixel) for each camera pixel. Size of IC is the same as input captured imgaes.
-    IC = phase_unwrap_cos_sin_to_column_index(CosSinMat, frequency_vec, pro[0], cam[1], cam[0])
-    IC = scipy.signal.medfilt2d(IC, medfilt_param) # Applying median filtering
+    if unwrap == "hierarchical":
+        IC = phase_unwrap_hierarchical(CosSinMat, frequency_vec, pro[0], cam[1], cam[0])
+    else:
+        IC = phase_unwrap_cos_sin_to_column_index(CosSinMat, frequency_vec, pro[0], cam[1], cam[0])
+    IC = signal.medfilt2d(IC, medfilt_param) # Applying median filtering
 
     return IC
 
 
 
+# Tiled, multi-process alternative to decode_mps for full resolution captures. Frames are numbered file_pattern % i
+# from first_frame, as saved by the mps_* scan scripts. The horizontal folder holds the frames of the column patterns,
+# the vertical folder the frames of the same patterns rotated to encode projector rows, so both coordinates are
+# decoded. The sensor is split into bands of band_rows rows that are decoded in separate processes in float32 and
+# written straight into the dense correspondence map of decode_single(dense=True) (with frac_bits of sub-pixel
+# precision). Workers only read the scanlines of their band, so peak memory depends on the band size rather than the
+# sensor size.
+# Pixels are valid if the amplitude of the first frequency is at least min_modulation times the offset in both sets
+def decode_mps_tiled(data_path, pattern_path, horizontal="mps_32/", vertical="mps_32_vertical/", out_dir="decoded",
+                     file_pattern="frame_%02d.exr", first_frame=1, pro=[1920, 1080], medfilt_param=5, min_modulation=0.05,
+                     frac_bits=4, band_rows=256, unwrap="brute", n_jobs=-1, ram_budget=None):
+    frequency_vec = scipy.io.loadmat(pattern_path + '/freqData.mat')["frequencyVec"][0]
+    num_frames = len(frequency_vec) + 2
+    Minv = np.linalg.inv(make_measurement_mat(len(frequency_vec))).astype(np.float32)
+
+    frames = [[data_path + dir + file_pattern % (first_frame + i) for i in range(num_frames)] for dir in [horizontal, vertical]]
+    shape = load_mps_frame(frames[0][0]).shape
+
+    save_path = data_path + "/" + out_dir + "/"
+    ensure_exists(save_path)
+    create_dense_correspondences(save_path, shape, frac_bits)
+    np.lib.format.open_memmap(save_path + "mask.npy", mode="w+", dtype=np.bool_, shape=shape)
+    with open(save_path + "undistorted.txt", "w") as f:
+        f.write(str(False))  # Correspondences are in raw sensor space
+
+    # The band of all frames (and its solution) plus the unwrapping blocks
+    band_bytes = 2 * num_frames * (band_rows + medfilt_param) * shape[1] * 4 + 256 * 1024**2
+    jobs = [joblib.delayed(decode_mps_band)(frames, save_path, r0, min(r0 + band_rows, shape[0]),
+            Minv, frequency_vec, pro, medfilt_param, min_modulation, frac_bits, unwrap) for r0 in range(0, shape[0], band_rows)]
+    counts = run_parallel(jobs, band_bytes, ram_budget, n_jobs)
+
+    print("Decoded %d of %d pixels" % (sum(counts), shape[0] * shape[1]))
+    return save_path
+
+
+# Decodes rows [r0, r1) of both frame sets. medfilt_param // 2 extra rows on each side make the median filter of the
+# band identical to the one of the full map
+def decode_mps_band(frames, save_path, r0, r1, Minv, frequency_vec, pro, medfilt_param, min_modulation, frac_bits, unwrap):
+    corr = np.load(save_path + "correspondences.npy", mmap_mode="r+")
+    mask = np.load(save_path + "mask.npy", mmap_mode="r+")
+    a0, a1 = max(0, r0 - medfilt_param // 2), min(corr.shape[0], r1 + medfilt_param // 2)
+    nr, nc = a1 - a0, corr.shape[1]
+
+    proj_xy, valid = np.zeros((r1 - r0, nc, 2)), np.ones((r1 - r0, nc), dtype=bool)
+    for i, (names, num_proj) in enumerate(zip(frames, pro)):
+        R = np.zeros((len(names), nr * nc), dtype=np.float32)
+        for j, name in enumerate(names):
+            R[j, :] = load_mps_frame(name, rows=(a0, a1)).T.reshape(-1) # Column major order, as in decode_mps
+
+        U = np.matmul(Minv, R)
+        del R
+        Amp = np.sqrt(U[1,:]**2 + U[2,:]**2)
+        modulated = (U[0,:] > 0) & (Amp >= min_modulation * U[0,:])
+        valid &= modulated.reshape((nc, nr)).T[r0-a0:r1-a0]
+
+        CosSinMat = U[1:, :] / np.maximum(Amp, np.finfo(np.float32).tiny)[None, :]
+        del U
+        if unwrap == "hierarchical":
+            IC = phase_unwrap_hierarchical(CosSinMat, frequency_vec, num_proj, nr, nc, check_pixels=0)
+        else:
+            IC = phase_unwrap_cos_sin_to_column_index(CosSinMat, frequency_vec, num_proj, nr, nc)
+        proj_xy[..., i] = signal.medfilt2d(IC, medfilt_param)[r0-a0:r1-a0]
+
+    q, in_range = encode_dense(proj_xy, frac_bits)
+    valid &= in_range
+    corr[r0:r1, :, 0] = np.where(valid, q[..., 0] | DENSE_VALID, 0)
+    corr[r0:r1, :, 1] = np.where(valid, q[..., 1], 0)
+    mask[r0:r1] = valid
+    corr.flush()
+    mask.flush()
+
+    return np.count_nonzero(valid)
+
+
 # This function converts the CosSinMat into column-correspondence.  
 #
 # CosSinMat is the matrix containing the sin and cos of the phases 
@@ -72,53 +174,130 @@ def decode_mps(images_path, pattern_path, prefix="img", suffix=".png", cam=[2048
 # the remaining frequencies, we have cos. 
 #
 # The function first performs a linear search on the projector column
-# indices. Then, it adds the sub-pixel component. 
+# indices. Then, it adds the sub-pixel component. See phase_unwrap_hierarchical
+# for a faster search over the columns consistent with the first frequency only.
 
-def phase_unwrap_cos_sin_to_column_index(CosSinMat, frequencyVec, numProjColumns, nr, nc):
-    x0 = np.array([list(range(0, numProjColumns))]) # Projector column indices
+def phase_unwrap_cos_sin_to_column_index(CosSinMat, frequencyVec, numProjColumns, nr, nc, block_bytes=256*1024**2):
+    TestMat = make_test_mat(CosSinMat.shape[0], frequencyVec, numProjColumns).astype(CosSinMat.dtype, copy=False)
+
+    IC = np.zeros((1, nr*nc), dtype="float64") # Vector of column-values
     
-    # Coomputing the cos and sin values for each projector column. The format 
-    # is the same as in CosSinMat - for the phase of the first frequency, we 
-    # have both sin and cos. For the phases of the remaining frequencies, we 
-    # have cos. These will be compared against the values in CosSinMat to find 
-    # the closest match. 
+    # For each camera pixel, find the closest match. Instead of a per pixel loop, blocks of pixels are matched at once
+    # using the expansion |v - t|^2 = |v|^2 - 2 v.t + |t|^2: |v|^2 does not change the argmin over columns, so each
+    # block is a single matrix multiply against TestMat. Block size keeps the (pixels x columns) scores within block_bytes
+    TestNorms = np.sum(TestMat**2, axis=0)
+    block = max(1, int(block_bytes // (numProjColumns * TestMat.itemsize)))
 
-    TestMat = np.tile(x0, (CosSinMat.shape[0], 1)).astype("float64")
+    for i in range(0, CosSinMat.shape[1], block):
+        Scores = np.matmul(CosSinMat[:, i:i+block].T, TestMat)
+        Scores *= -2
+        Scores += TestNorms[None, :]
+        IC[0, i:i+block] = np.argmin(Scores, axis=1)
+
+    IC = add_fractional_part(IC, CosSinMat, frequencyVec)
+
+    IC = np.reshape(IC, [nr, nc], order='F')
+    return IC
+
+
+# Coomputing the cos and sin values for each projector column. The format 
+# is the same as in CosSinMat - for the phase of the first frequency, we 
+# have both sin and cos. For the phases of the remaining frequencies, we 
+# have cos. These will be compared against the values in CosSinMat to find 
+# the closest match. 
+
+def make_test_mat(numRows, frequencyVec, numProjColumns):
+    x0 = np.array([list(range(0, numProjColumns))]) # Projector column indices
+
+    TestMat = np.tile(x0, (numRows, 1)).astype("float64")
     
     TestMat[0,:] = np.cos((np.mod(TestMat[0,:], frequencyVec[0]) / frequencyVec[0]) * 2 * np.pi) # cos of the phase for the first frequency
     TestMat[1,:] = np.sin((np.mod(TestMat[1,:], frequencyVec[0]) / frequencyVec[0]) * 2 * np.pi) # sin of the phase for the first frequency
 
-    for i in range(2, CosSinMat.shape[0]):
+    for i in range(2, numRows):
         TestMat[i,:] = np.cos((np.mod(TestMat[i,:], frequencyVec[i-1]) / frequencyVec[i-1]) * 2 * np.pi) # cos of the phases of the remaining frequency
-        
-    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
-    IC = np.zeros((1, nr*nc), dtype="float64") # Vector of column-values
-    
-    # For each camera pixel, find the closest match
-    # TODO parpool(4);% This loop can be run in parallel using MATLAB parallel toolbox. The number here is the number of cores on your machine. 
-    for i in range(0, CosSinMat.shape[1]):
-        CosSinVec = CosSinMat[:,i]
-        CosSinVec = CosSinVec.reshape((CosSinVec.shape[0], 1))
-        ErrorVec = np.sum(np.abs(np.tile(CosSinVec, (1, numProjColumns)) - TestMat)**2, axis=0)
-        #print(ErrorVec.shape, ErrorVec)
-        Ind = np.argmin(ErrorVec)
-        #print(Ind)
-        IC[0, i] = Ind
-
-    # Computing the fractional value using phase values of the first frequency 
-    # since it has both cos and sin values. 
+    return TestMat
 
+
+def column_first_frequency(CosSinMat, frequencyVec):
     PhaseFirstFrequency = np.arccos(CosSinMat[0,:]) # acos returns values in [0, pi] range. There is a 2 way ambiguity.
     PhaseFirstFrequency[CosSinMat[1,:]<0] = 2 * np.pi - PhaseFirstFrequency[CosSinMat[1,:]<0] # Using the sin value to resolve the ambiguity
-    ColumnFirstFrequency = PhaseFirstFrequency * frequencyVec[0] / (2 * np.pi) # The phase for the first frequency, in pixel units. This is equal to mod(trueColumn, frequencyVec(1)). 
+    return PhaseFirstFrequency * frequencyVec[0] / (2 * np.pi) # The phase for the first frequency, in pixel units. This is equal to mod(trueColumn, frequencyVec(1)). 
+
+
+# Computing the fractional value using phase values of the first frequency 
+# since it has both cos and sin values. 
+
+def add_fractional_part(IC, CosSinMat, frequencyVec):
+    ColumnFirstFrequency = column_first_frequency(CosSinMat, frequencyVec)
 
     NumCompletePeriodsFirstFreq = np.floor(IC / frequencyVec[0]) # The number of complete periods for the first frequency 
     ICFrac = NumCompletePeriodsFirstFreq * frequencyVec[0] + ColumnFirstFrequency # The final correspondence, with the fractional component
 
     # If the difference after fractional correction is large (because of noise), keep the original value. 
     ICFrac[np.abs(ICFrac-IC)>=1] = IC[np.abs(ICFrac-IC)>=1]
-    IC = ICFrac
+    return ICFrac
+
+
+# Coarse-to-fine alternative to the brute force search above. The phase of the first frequency (known from both its cos
+# and sin) pins the column down to mod(column, frequencyVec[0]), so only columns k * frequencyVec[0] + that phase
+# (+- spread columns for noise) are consistent with it. Only those ~numProjColumns / frequencyVec[0] candidates per
+# pixel are scored against all frequencies. Agreement with the brute force result is reported on check_pixels random
+# pixels (0 to skip the check)
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _search_candidates_jit(CosSinMat, TestRows, TestNorms, ColumnFirstFrequency, period, numPeriods, spread, IC):
+        numProjColumns = TestRows.shape[0]
+        for i in numba.prange(CosSinMat.shape[1]):
+            best, best_c = np.inf, 0
+            for k in range(numPeriods):
+                c0 = int(np.round(ColumnFirstFrequency[i] + k * period))
+                for c in range(max(0, c0 - spread), min(numProjColumns, c0 + spread + 1)):
+                    score = TestNorms[c]
+                    for f in range(CosSinMat.shape[0]):
+                        score -= 2 * CosSinMat[f, i] * TestRows[c, f]
+                    if score < best: # candidates come in increasing order, so ties resolve to the lowest column
+                        best, best_c = score, c
+            IC[0, i] = best_c
+
+
+def phase_unwrap_hierarchical(CosSinMat, frequencyVec, numProjColumns, nr, nc, spread=2, block_bytes=256*1024**2, check_pixels=10000):
+    TestMat = make_test_mat(CosSinMat.shape[0], frequencyVec, numProjColumns).astype(CosSinMat.dtype, copy=False)
+    TestNorms = np.sum(TestMat**2, axis=0)
+    TestRows = np.ascontiguousarray(TestMat.T) # one row per projector column for fast gathering of candidates
+
+    ColumnFirstFrequency = column_first_frequency(CosSinMat, frequencyVec)
+    ColumnFirstFrequency[np.isnan(ColumnFirstFrequency)] = 0
+
+    periods = np.arange(int(np.ceil(numProjColumns / frequencyVec[0])) + 1) * frequencyVec[0]
+    offsets = np.arange(-spread, spread + 1)
+    numCandidates = periods.shape[0] * offsets.shape[0]
+
+    IC = np.zeros((1, nr*nc), dtype="float64") # Vector of column-values
+    block = max(1, int(block_bytes // (numCandidates * CosSinMat.shape[0] * TestMat.itemsize)))
+
+    if numba is not None:
+        _search_candidates_jit(np.ascontiguousarray(CosSinMat), TestRows, TestNorms, ColumnFirstFrequency,
+                               float(frequencyVec[0]), periods.shape[0], spread, IC)
+    else:
+        for i in range(0, CosSinMat.shape[1], block):
+            CosSinBlock = CosSinMat[:, i:i+block].T
+            Candidates = np.round(ColumnFirstFrequency[i:i+block, None] + periods[None, :]).astype(np.int64)
+            Candidates = (Candidates[:, :, None] + offsets[None, None, :]).reshape(Candidates.shape[0], -1)
+            Candidates = np.sort(np.clip(Candidates, 0, numProjColumns - 1), axis=1) # ties resolve to the lowest column, as in brute force
+
+            Scores = TestNorms[Candidates] - 2 * np.matmul(TestRows[Candidates], CosSinBlock[:, :, None])[:, :, 0]
+            IC[0, i:i+block] = Candidates[np.arange(Candidates.shape[0]), np.argmin(Scores, axis=1)]
+
+    if check_pixels > 0:
+        idx = np.random.choice(CosSinMat.shape[1], min(check_pixels, CosSinMat.shape[1]), replace=False)
+        Scores = TestNorms[None, :] - 2 * np.matmul(CosSinMat[:, idx].T, TestMat)
+        agreement = np.mean(np.argmin(Scores, axis=1) == IC[0, idx])
+        print("Hierarchical unwrapping agrees with brute force on %.3f%% of %d checked pixels" % (100 * agreement, idx.shape[0]))
+
+    IC = add_fractional_part(IC, CosSinMat, frequencyVec)
 
     IC = np.reshape(IC, [nr, nc], order='F')
     return IC
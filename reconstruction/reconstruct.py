@@ -1,23 +1,25 @@
 import itertools
 import os
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import json
 import Imath
 import OpenEXR
-import joblib
 import scipy
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
-from scipy.optimize import least_squares
 from utils import *
 from process import *
 from decode import *
-from scipy.ndimage.filters import gaussian_filter
-import scipy.ndimage.morphology as morph
-from skimage import measure
-from skimage import filters
-from scipy.spatial.transform import Rotation as R
+
+try:
+    import numba  # Optional: compiled bilinear ray lookup (NumPy fallback otherwise)
+except ImportError:
+    numba = None
+
+R = LazyObject("scipy.spatial.transform", "Rotation")
 
 
 # Unused. Replaced with cv2.undistortPoints(..., P=None)
@@ -26,23 +28,218 @@ def img_to_ray(p_img, mtx):
     return np.concatenate([p_img, np.ones((p_img.shape[0], 1))], axis=1)
 
 
-def triangulate(cam_rays, proj_xy, proj_calib, undistort=True):
+# (n, 2) camera pixels to normalized image coords. undistorted: pixels of undistorted images (decoded with
+# undistort=cam_calib), which only need new_mtx. Otherwise raw sensor pixels, undistorted with mtx and dist
+def undistort_camera_points(cam_xy, cam_calib, undistorted=False):
+    cam_xy = np.asarray(cam_xy, dtype=np.float64).reshape((-1, 1, 2))
+    if undistorted:
+        return cv2.undistortPoints(cam_xy, cam_calib["new_mtx"], None).reshape((-1, 2))
+    else:
+        return cv2.undistortPoints(cam_xy, cam_calib["mtx"], cam_calib["dist"]).reshape((-1, 2))
+
+
+# Short hash of the calib entries in keys (plus any extra values), used to name cached lookup tables
+def calibration_key(calib, keys, *extra):
+    h = hashlib.sha1()
+    for k in keys:
+        if k in calib and calib[k] is not None:
+            h.update(k.encode())
+            h.update(np.ascontiguousarray(calib[k], dtype=np.float64).tobytes())
+    h.update(repr(extra).encode())
+    return h.hexdigest()[:16]
+
+
+def get_ray_cache_dir(cache_dir=None):
+    return cache_dir or os.environ.get("SCANNER_RAY_CACHE") or os.path.join(tempfile.gettempdir(), "scanner_ray_cache")
+
+
+_ray_maps = {}
+
+
+# (height, width, 3) ray map named name_key.npy in the ray cache folder (SCANNER_RAY_CACHE environment variable,
+# scanner_ray_cache in the temp folder by default). fill(rays, r0, r1) computes rows r0:r1 if the map is not cached
+# yet. Later calls, in this or any other process, memory-map the saved map
+def cached_ray_map(name, key, shape, fill, cache_dir=None, dtype=np.float32, chunk_rows=256):
+    if (name, key) in _ray_maps:
+        return _ray_maps[name, key]
+
+    cache_dir = get_ray_cache_dir(cache_dir)
+    filename = cache_dir + "/%s_%s.npy" % (name, key)
+    if not os.path.exists(filename):
+        ensure_exists(cache_dir + "/")
+        print("Computing %s:" % name, filename)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())  # Other processes may be computing the same map
+        rays = np.lib.format.open_memmap(tmp_filename, mode="w+", dtype=dtype, shape=(shape[0], shape[1], 3))
+        for r0 in range(0, shape[0], chunk_rows):
+            fill(rays, r0, min(r0 + chunk_rows, shape[0]))
+        rays.flush()
+        del rays
+        os.replace(tmp_filename, filename)
+
+    _ray_maps[name, key] = np.load(filename, mmap_mode="r")
+    return _ray_maps[name, key]
+
+
+# (x, y) = (col, row) coords of all pixels in rows r0:r1 of an image width pixels wide, as (n, 2) float64
+def pixel_grid(r0, r1, width):
+    x, y = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(r0, r1, dtype=np.float64))
+    return np.stack([x.ravel(), y.ravel()], axis=1)
+
+
+# Camera rays of all pixels of a (height, width) image as an (height, width, 3) float32 map: (u, v, 1) with u, v the
+# undistorted normalized coords of pixel (x, y) = (col, row). The camera calibration is the same for all positions of
+# a scan, so the map is computed once per calibration, image shape and mode (see undistort_camera_points) and cached
+def camera_ray_map(cam_calib, shape, undistorted=False, cache_dir=None):
+    def fill(rays, r0, r1):
+        u = undistort_camera_points(pixel_grid(r0, r1, shape[1]), cam_calib, undistorted)
+        rays[r0:r1, :, :2] = u.reshape((r1 - r0, shape[1], 2))
+        rays[r0:r1, :, 2] = 1
+
+    key = calibration_key(cam_calib, ["new_mtx"] if undistorted else ["mtx", "dist"], tuple(shape[:2]), undistorted)
+    return cached_ray_map("camera_rays", key, shape, fill, cache_dir)
+
+
+# Projector rays in world orientation (rotated by proj_calib["basis"]) at all integer projector coords (x, y) with
+# 0 <= x <= width and 0 <= y <= height, i.e. a (height + 1, width + 1, 3) map. The extra row and column hold the last
+# pixel edge, which decoded codes reach with the +1.0 offset applied in reconstruct_single. undistort has the meaning
+# of triangulate. Kept in float64 (only ~50 MB), so rays of integer codes are exact
+def projector_ray_lut(proj_calib, undistort=True, cache_dir=None):
+    width, height = proj_calib.get("image_width, pixels", 1920), proj_calib.get("image_height, pixels", 1080)
+
+    def fill(rays, r0, r1):
+        rays[r0:r1] = projector_rays(pixel_grid(r0, r1, width + 1), proj_calib, undistort).reshape((r1 - r0, width + 1, 3))
+
+    key = calibration_key(proj_calib, ["mtx", "dist", "basis"] if undistort else ["new_mtx", "basis"], width, height, undistort)
+    return cached_ray_map("projector_rays", key, (height + 1, width + 1), fill, cache_dir, dtype=np.float64)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _bilinear_rays_jit(flat, h, w, xy, rays):
+        for k in numba.prange(xy.shape[0]):
+            x, y = min(max(xy[k, 0], 0.0), w - 1.0), min(max(xy[k, 1], 0.0), h - 1.0)
+            x0, y0 = min(int(x), max(w - 2, 0)), min(int(y), max(h - 2, 0))
+            fx, fy = x - x0, y - y0
+            i = y0 * w + x0
+            dx, dy = (1 if w > 1 else 0), (w if h > 1 else 0)
+            for j in range(flat.shape[1]):
+                top = flat[i, j] * (1 - fx) + flat[i + dx, j] * fx
+                bottom = flat[i + dy, j] * (1 - fx) + flat[i + dx + dy, j] * fx
+                rays[k, j] = top * (1 - fy) + bottom * fy
+
+
+# Rays at integer pixels cam_xy (n, 2) are gathered from the map, sub-pixel positions (e.g. group centroids or MPS
+# codes) are bilinearly interpolated from the 4 neighbouring pixels (clamped to the map). The numba kernel is only used
+# on the main thread: parallel numba kernels started from other threads abort (workqueue) or hang on exit (tbb)
+def lookup_rays(ray_map, cam_xy, jit=True):
+    h, w = ray_map.shape[:2]
+    if not np.issubdtype(cam_xy.dtype, np.integer) and np.all(np.floor(cam_xy) == cam_xy):
+        cam_xy = cam_xy.astype(np.int64)
+    if np.issubdtype(cam_xy.dtype, np.integer):
+        return ray_map[cam_xy[:, 1], cam_xy[:, 0]]
+
+    if jit and numba is not None and threading.current_thread() is threading.main_thread():
+        rays = np.empty((cam_xy.shape[0], ray_map.shape[2]), dtype=ray_map.dtype)
+        _bilinear_rays_jit(np.asarray(ray_map).reshape((-1, ray_map.shape[2])), h, w,
+                           np.ascontiguousarray(cam_xy, dtype=np.float64), rays)
+        return rays
+
+    # Flat indices of the top-left neighbours, the others are at +1, +w and +w+1
+    x, y = np.clip(cam_xy[:, 0], 0, w - 1), np.clip(cam_xy[:, 1], 0, h - 1)
+    x0, y0 = np.minimum(x.astype(np.int64), max(w - 2, 0)), np.minimum(y.astype(np.int64), max(h - 2, 0))
+    fx, fy = (x - x0).astype(ray_map.dtype)[:, None], (y - y0).astype(ray_map.dtype)[:, None]
+    i = y0 * w + x0
+    dx, dy = (1 if w > 1 else 0), (w if h > 1 else 0)
+
+    flat = ray_map.reshape((-1, ray_map.shape[2]))
+    rays = np.take(flat, i, axis=0) * ((1 - fx) * (1 - fy))
+    rays += np.take(flat, i + dx, axis=0) * (fx * (1 - fy))
+    rays += np.take(flat, i + dy, axis=0) * ((1 - fx) * fy)
+    rays += np.take(flat, i + dx + dy, axis=0) * (fx * fy)
+    return rays
+
+
+# Rays through projector coords proj_xy (n, 2), rotated by proj_calib["basis"]
+def projector_rays(proj_xy, proj_calib, undistort=True):
     if undistort:
-        u_proj_xy = cv2.undistortPoints(proj_xy.astype(np.float).reshape((-1, 1, 2)),
+        u_proj_xy = cv2.undistortPoints(proj_xy.astype(np.float64).reshape((-1, 1, 2)),
                                         proj_calib["mtx"], proj_calib["dist"]).reshape((-1, 2))
     else:
-        u_proj_xy = cv2.undistortPoints(proj_xy.astype(np.float).reshape((-1, 1, 2)),
+        u_proj_xy = cv2.undistortPoints(proj_xy.astype(np.float64).reshape((-1, 1, 2)),
                                         proj_calib["new_mtx"], None).reshape((-1, 2))
 
     proj_rays = np.concatenate([u_proj_xy, np.ones((u_proj_xy.shape[0], 1))], axis=1)
-    proj_rays = np.matmul(proj_calib["basis"].T, proj_rays.T).T
-    proj_origin = proj_calib["origin"]
+    return np.matmul(proj_calib["basis"].T, proj_rays.T).T
+
+
+# proj_lut (see projector_ray_lut) replaces undistorting every proj_xy with a lookup, coords outside of it are
+# still undistorted exactly. Points are computed in dtype, into out if given
+def triangulate(cam_rays, proj_xy, proj_calib, undistort=True, proj_lut=None, dtype=np.float64, out=None):
+    if proj_lut is None:
+        proj_rays = projector_rays(proj_xy, proj_calib, undistort)
+    else:
+        inside = np.all((proj_xy >= 0) & (proj_xy <= [proj_lut.shape[1] - 1, proj_lut.shape[0] - 1]), axis=1)
+        if np.all(inside):
+            proj_rays = lookup_rays(proj_lut, proj_xy)
+        else:
+            proj_rays = np.zeros((proj_xy.shape[0], 3), dtype=np.float64)
+            proj_rays[inside] = lookup_rays(proj_lut, proj_xy[inside])
+            proj_rays[~inside] = projector_rays(proj_xy[~inside], proj_calib, undistort)
+    cam_rays, proj_rays = cam_rays.astype(dtype, copy=False), proj_rays.astype(dtype, copy=False)
+    proj_origin = np.asarray(proj_calib["origin"], dtype=dtype)
+
+    v12 = np.einsum("ij,ij->i", cam_rays, proj_rays)
+    v1, v2 = np.einsum("ij,ij->i", cam_rays, cam_rays), np.einsum("ij,ij->i", proj_rays, proj_rays)
+    L = np.matmul(cam_rays, proj_origin) * v2
+    L -= np.matmul(proj_rays, proj_origin) * v12
+    L /= v1 * v2 - v12**2
+
+    return np.multiply(cam_rays, L[:, None], out=out)
+
+
+# Triangulates chunk_size points at a time into a preallocated (n, 3) dtype array (out if given), so temporaries stay
+# bounded by the chunk size instead of growing with the number of points. cam_rays is either (n, 3) rays or, with
+# cam_xy (n, 2), a camera ray map (see camera_ray_map) to look the rays up from chunk by chunk. proj_offset is added to
+# proj_xy per chunk. n_threads > 1 runs chunks on a thread pool (NumPy and OpenCV release the GIL)
+def triangulate_chunked(cam_rays, proj_xy, proj_calib, cam_xy=None, undistort=True, proj_lut=None, proj_offset=None,
+                        dtype=np.float32, chunk_size=2**20, n_threads=1, out=None):
+    n = proj_xy.shape[0]
+    if out is None:
+        out = np.empty((n, 3), dtype=dtype)
+
+    def run(i):
+        j = min(i + chunk_size, n)
+        rays = lookup_rays(cam_rays, cam_xy[i:j]) if cam_xy is not None else cam_rays[i:j]
+        chunk_xy = proj_xy[i:j] if proj_offset is None else proj_xy[i:j] + proj_offset
+        triangulate(rays, chunk_xy, proj_calib, undistort, proj_lut, dtype, out[i:j])
+
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(run, range(0, n, chunk_size)))
+    else:
+        for i in range(0, n, chunk_size):
+            run(i)
 
-    v12 = np.sum(np.multiply(cam_rays, proj_rays), axis=1)
-    v1, v2 = np.linalg.norm(cam_rays, axis=1)**2, np.linalg.norm(proj_rays, axis=1)**2
-    L = (np.matmul(cam_rays, proj_origin) * v2 + np.matmul(proj_rays, -proj_origin) * v12) / (v1 * v2 - v12**2)
+    return out
 
-    return cam_rays * L[:, None]
+
+# (height, width) image with the pixels of groups idx set to values (one per group in idx), zero elsewhere. group_rcs
+# is a PixelGroups or a list of (k, 2) coords as in group_rcs.pkl. Instead of a loop over groups, every group value is
+# repeated by its pixel count to line up with the flat pixel indices of the groups and written with a single scatter
+def paint_groups(shape, group_rcs, idx, values, dtype=np.float32):
+    if not isinstance(group_rcs, PixelGroups):
+        group_rcs = PixelGroups.from_coords(group_rcs, shape[1])
+
+    group_values = np.zeros(len(group_rcs), dtype=dtype)
+    group_values[idx] = values
+    keep = np.zeros(len(group_rcs), dtype=np.bool_)
+    keep[idx] = True
+
+    counts = group_rcs.counts
+    pixel_keep = np.repeat(keep, counts)
+    image = np.zeros(shape[0] * shape[1], dtype=dtype)
+    image[np.asarray(group_rcs.indices)[pixel_keep]] = np.repeat(group_values, counts)[pixel_keep]
+    return image.reshape(shape[:2])
 
 
 def calculate_normals_from_p3d(points, mask):
@@ -53,6 +250,37 @@ def calculate_normals_from_p3d(points, mask):
     return normals
 
 
+# Same normals as calculate_normals_from_p3d (including its wrap around at the image borders and zero points at pixels
+# without a point), but only evaluated at the pixels query_xy (m, 2) instead of the full frame. points (n, 3) are the
+# points of the pixels cam_xy (n, 2) of an image of shape. Neighbours are found through an index map over the bounding
+# box of cam_xy, and queries are processed chunk_size at a time, so no (height, width, 3) arrays are allocated
+def calculate_normals_sparse(points, cam_xy, shape, query_xy, chunk_size=2**20):
+    if cam_xy.shape[0] == 0:
+        return np.zeros((query_xy.shape[0], 3), dtype=points.dtype)  # No points, no neighbours
+
+    h, w = shape[:2]
+    c0, r0 = np.min(cam_xy, axis=0).astype(np.int64)
+    c1, r1 = np.max(cam_xy, axis=0).astype(np.int64) + 1
+    index = np.zeros((r1 - r0, c1 - c0), dtype=np.int32 if points.shape[0] < 2**31 - 1 else np.int64)
+    index[cam_xy[:, 1] - r0, cam_xy[:, 0] - c0] = np.arange(1, points.shape[0] + 1)  # 0: no point
+
+    def neighbour(r, c):
+        inside = (r >= r0) & (r < r1) & (c >= c0) & (c < c1)
+        j = np.where(inside, index[np.clip(r - r0, 0, index.shape[0] - 1), np.clip(c - c0, 0, index.shape[1] - 1)], 0)
+        p = points[np.maximum(j - 1, 0)]
+        p[j == 0] = 0
+        return p
+
+    normals = np.zeros((query_xy.shape[0], 3), dtype=points.dtype)
+    for i in range(0, query_xy.shape[0], chunk_size):
+        c, r = query_xy[i:i+chunk_size, 0].astype(np.int64), query_xy[i:i+chunk_size, 1].astype(np.int64)
+        dx = neighbour(r, (c + 1) % w) - neighbour(r, (c - 1) % w)
+        dy = neighbour((r + 1) % h, c) - neighbour((r - 1) % h, c)
+        normals[i:i+chunk_size] = -np.cross(dx, dy)
+
+    return normals
+
+
 def calculate_normals_from_dm(dm):
     zy, zx = np.gradient(dm)
     normals = np.dstack((zx, zy, -np.ones_like(dm)))
@@ -61,56 +289,88 @@ def calculate_normals_from_dm(dm):
     return normals
 
 
-def reconstruct_single(data_path, cam_calib, proj_calib, out_dir="reconstructed", max_group=25, gen_depth_map=True,
-                       save=True, plot=False, save_figures=True, verbose=False, extract_normals=True, extract_colors=True, sim=False, file_pattern="img_%02d.exr", **kw):
-    if sim:
-        white_path = data_path + "/" + file_pattern%0
-    else: 
-        white_path = None
-    
+# preview=True reconstructs the strided decode_single(preview=...) output from "decoded_preview" into
+# "reconstructed_preview", triangulating with the camera intrinsics rescaled by the stride saved next to it.
+# Further keyword arguments are passed to reconstruct_decoded
+def reconstruct_single(data_path, cam_calib, proj_calib, out_dir=None, max_group=25, gen_depth_map=True,
+                       save=True, plot=False, save_figures=True, verbose=False, extract_normals=True, extract_colors=True, sim=False, file_pattern="img_%02d.exr", preview=False, **kw):
+    if out_dir is None:
+        out_dir = "reconstructed_preview" if preview else "reconstructed"
+
+    if extract_colors and sim:
+        white = load_openexr(data_path + "/" + file_pattern%0, make_gray=False, load_depth=False)
+    else:
+        white = None
+
     if save:
         save_path = data_path + out_dir + "/"
         ensure_exists(save_path)
     else:
         save_path = None
 
-    data_path += "decoded/"
+    data_path += "decoded_preview/" if preview else "decoded/"
     all, groups = load_decoded(data_path)
+    # "True" if decoded from undistorted images, otherwise ("False" / "points") correspondences are in raw sensor space
+    undistorted = open(data_path + "undistorted.txt", "r").read().strip() == "True"
+    stride = int(open(data_path + "stride.txt", "r").read()) if os.path.exists(data_path + "stride.txt") else 1
+    print("Loaded:", data_path)
+
+    return reconstruct_decoded(all, groups, cam_calib, proj_calib, undistorted, stride, white, save_path, data_path,
+                               max_group=max_group, gen_depth_map=gen_depth_map, plot=plot, save_figures=save_figures,
+                               verbose=verbose, extract_normals=extract_normals, **kw)
+
+
+# Reconstruction of decoded correspondences (all, groups) as returned by decode_single / load_decoded. undistorted and
+# stride describe how they were decoded (see decode_single). Colors are taken from the RGB white frame if given, and
+# outputs are written to save_path if given (name is used in plot titles).
+# With ray_cache camera and projector rays come from the cached camera_ray_map and projector_ray_lut instead of
+# undistorting all decoded pixels and codes again. Points are triangulated in dtype, chunk_size points at a time on
+# n_threads threads (see triangulate_chunked). sparse_normals only evaluates normals at the pixels that need them
+# (see calculate_normals_sparse) instead of on full frame arrays
+def reconstruct_decoded(all, groups, cam_calib, proj_calib, undistorted=False, stride=1, white=None, save_path=None,
+                        name="", max_group=25, gen_depth_map=True, plot=False, save_figures=True, verbose=False,
+                        extract_normals=True, ray_cache=True, ray_cache_dir=None, dtype=np.float32, chunk_size=2**20,
+                        n_threads=1, sparse_normals=True, **kw):
+    save = save_path is not None
     cam_xy, proj_xy, mask = all
     if groups:
         group_cam_xy, group_proj_xy, group_counts, group_rcs = groups
-    undistorted = bool(open(data_path + "undistorted.txt", "r").read())
-    print("Loaded:", data_path)
+    if stride > 1:
+        cam_calib = scale_calibration(cam_calib, 1.0 / stride)
 
-    if undistorted:
-        u_cam_xy = cv2.undistortPoints(cam_xy.astype(np.float).reshape((-1, 1, 2)), cam_calib["new_mtx"], None).reshape((-1, 2))
-        if groups:
-            u_group_cam_xy = cv2.undistortPoints(group_cam_xy.astype(np.float).reshape((-1, 1, 2)), cam_calib["new_mtx"], None).reshape((-1, 2))
+    if groups:
+        idx = np.nonzero(group_counts < max_group)[0]
+        print("%d groups larger than %d excluded" % (group_counts.shape[0] - idx.shape[0], max_group))
+        group_cam_xy, group_proj_xy = group_cam_xy[idx, :], group_proj_xy[idx, :]
+
+    proj_lut = None
+    if ray_cache:
+        proj_lut = projector_ray_lut(proj_calib, cache_dir=ray_cache_dir)
+        ray_map = camera_ray_map(cam_calib, mask.shape, undistorted, ray_cache_dir)
+        cam_rays = group_cam_rays = ray_map
     else:
-        u_cam_xy = cv2.undistortPoints(cam_xy.astype(np.float), cam_calib["mtx"], cam_calib["dist"]).reshape((-1, 2))
+        u_cam_xy = undistort_camera_points(cam_xy, cam_calib, undistorted)
+        cam_rays = np.concatenate([u_cam_xy, np.ones((u_cam_xy.shape[0], 1))], axis=1)
         if groups:
-            u_group_cam_xy = cv2.undistortPoints(group_cam_xy.astype(np.float), cam_calib["mtx"], cam_calib["dist"]).reshape((-1, 2))
-
-    cam_rays = np.concatenate([u_cam_xy, np.ones((u_cam_xy.shape[0], 1))], axis=1)
-    if groups:
-        group_cam_rays = np.concatenate([u_group_cam_xy, np.ones((u_group_cam_xy.shape[0], 1))], axis=1)
+            u_group_cam_xy = undistort_camera_points(group_cam_xy, cam_calib, undistorted)
+            group_cam_rays = np.concatenate([u_group_cam_xy, np.ones((u_group_cam_xy.shape[0], 1))], axis=1)
 
     print("Triangulating...")
+    engine = dict(proj_lut=proj_lut, dtype=dtype, chunk_size=chunk_size, n_threads=n_threads)
 
     # Add (0.5, 0.5) to proj_xy to make rays pass through the centers of decoded projector pixels.
     # Add another (0.5, 0.5) because of Mitsuba convention in projector calibration.
-    all_points = triangulate(cam_rays, proj_xy + np.array([0.5 + 0.5, 0.5 + 0.5])[None, :], proj_calib)
+    all_points = triangulate_chunked(cam_rays, proj_xy, proj_calib, cam_xy if ray_cache else None,
+                                     proj_offset=np.array([0.5 + 0.5, 0.5 + 0.5]), **engine)
+    group_points = None
     if groups:
-        group_points = triangulate(group_cam_rays, group_proj_xy, proj_calib)
-        idx = np.nonzero(group_counts < max_group)[0]
-        print("%d groups larger than %d excluded" % (group_counts.shape[0] - idx.shape[0], max_group))
-        group_points = group_points[idx, :]
-        group_cam_xy = group_cam_xy[idx, :]
+        group_points = triangulate_chunked(group_cam_rays, group_proj_xy, proj_calib,
+                                           group_cam_xy if ray_cache else None, **engine)
         
     # Extract colors        
     all_colors = group_colors = None
-    if extract_colors and white_path is not None:
-        white, _ = load_openexr(white_path, make_gray=False, load_depth=False)
+    if white is not None:
+        white = white[::stride, ::stride]
         #print(np.min(white), np.max(white))
         ma = np.max(white)
         mi = np.min(white)
@@ -119,9 +379,10 @@ def reconstruct_single(data_path, cam_calib, proj_calib, out_dir="reconstructed"
         all_colors = all_colors[mask]
         all_colors = all_colors.reshape(-1, 3)
 
-        group_idxs = group_cam_xy.astype("int32")
-        #print(group_idxs.shape)
-        group_colors = white[group_idxs[:, 1], group_idxs[:, 0]]
+        if groups:
+            group_idxs = group_cam_xy.astype("int32")
+            #print(group_idxs.shape)
+            group_colors = white[group_idxs[:, 1], group_idxs[:, 0]]
 
     # Generate depth maps
     if gen_depth_map:
@@ -130,33 +391,40 @@ def reconstruct_single(data_path, cam_calib, proj_calib, out_dir="reconstructed"
         full_depth_map[cam_xy[:, 1], cam_xy[:, 0]] = np.linalg.norm(all_points, axis=1)
 
         if groups:
-            group_depth_map = np.zeros_like(mask, dtype=np.float32)
-            for i, id in enumerate(idx):
-                rcs = group_rcs[id]
-                if i % 100000 == 0 and verbose:
-                    print("Group", i)
-                group_depth_map[rcs[:, 0], rcs[:, 1]] = np.linalg.norm(group_points[i, :])
+            group_depth_map = paint_groups(mask.shape, group_rcs, idx, np.linalg.norm(group_points, axis=1))
                 
     # Generate normals
     all_normals = group_normals = None
     if extract_normals:
-        full_points = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.float32)
-        full_points[cam_xy[:, 1], cam_xy[:, 0], :] = all_points
-        all_normals = calculate_normals_from_p3d(full_points, mask)
-        #all_normals = calculate_normals_from_dm(full_depth_map)
+        if sparse_normals:
+            mask_r, mask_c = np.nonzero(mask)
+            all_normals = calculate_normals_sparse(all_points.astype(np.float32, copy=False), cam_xy, mask.shape,
+                                                   np.stack([mask_c, mask_r], axis=1), chunk_size)
+            del mask_r, mask_c
+            if groups:
+                group_normals = calculate_normals_sparse(all_points.astype(np.float32, copy=False), cam_xy, mask.shape,
+                                                         group_cam_xy.astype("int32"), chunk_size)
+        else:
+            full_points = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.float32)
+            full_points[cam_xy[:, 1], cam_xy[:, 0], :] = all_points
+            all_normals = calculate_normals_from_p3d(full_points, mask)
+            #all_normals = calculate_normals_from_dm(full_depth_map)
+            del full_points
+
+            if groups:
+                group_idxs = group_cam_xy.astype("int32")
+                group_normals = all_normals[group_idxs[:, 1], group_idxs[:, 0]]
+
+            all_normals = all_normals[mask]
 
-        group_idxs = group_cam_xy.astype("int32")
-        group_normals = all_normals[group_idxs[:, 1], group_idxs[:, 0]]
-        
-        all_normals = all_normals[mask]
-        
         all_norm = np.linalg.norm(all_normals, axis=1)
         all_nonzero = all_norm > 0
         all_normals[all_nonzero] /= all_norm[all_nonzero, None]
-        
-        group_norm = np.linalg.norm(group_normals, axis=1)
-        group_nonzero = group_norm > 0
-        group_normals[group_nonzero] /= group_norm[group_nonzero, None]
+
+        if groups:
+            group_norm = np.linalg.norm(group_normals, axis=1)
+            group_nonzero = group_norm > 0
+            group_normals[group_nonzero] /= group_norm[group_nonzero, None]
 
     if save:
         save_ply(save_path + "all_points.ply", all_points, all_normals, all_colors)
@@ -181,22 +449,76 @@ def reconstruct_single(data_path, cam_calib, proj_calib, out_dir="reconstructed"
 
         if gen_depth_map:
             vmin = np.min(full_depth_map[full_depth_map > 1])
-            plot_image(full_depth_map, "Full Depth Map", data_path + " - Full Depth Map", vmin=vmin, save_as=save_path + "full_depth_map" if save_path else None)
+            plot_image(full_depth_map, "Full Depth Map", name + " - Full Depth Map", vmin=vmin, save_as=save_path + "full_depth_map" if save_path else None)
             if groups:
                 vmin = np.min(full_depth_map[group_depth_map > 1])
-                plot_image(group_depth_map, "Group Depth Map", data_path + " - Group Depth Map", vmin=vmin, save_as=save_path + "group_depth_map" if save_path else None)
+                plot_image(group_depth_map, "Group Depth Map", name + " - Group Depth Map", vmin=vmin, save_as=save_path + "group_depth_map" if save_path else None)
+
+    return all_points, group_points, group_colors, group_depth_map/1000.0 if groups and gen_depth_map else None
+
+
+# Decodes (decode_single with **kw) and reconstructs (reconstruct_decoded with reconstruct_kw) one position in memory,
+# without the round trip through the decoded folder, so only the reconstruction is written to data_path + out_dir.
+# save_decoded=True writes the decoded folder as well, as decode_single(save=True) does. With sim and extract_colors
+# the white frame is read once, for both the decoding mask and the colors
+def decode_reconstruct_single(data_path, cam_calib, proj_calib, out_dir=None, save=True, save_decoded=False, group=True,
+                              extract_colors=True, sim=False, file_pattern="img_%02d.exr", preview=None, undistort=None,
+                              undistort_mode="images", load_depth=False, reconstruct_kw=None, **kw):
+    if out_dir is None:
+        out_dir = "reconstructed_preview" if preview else "reconstructed"
+
+    white = white_rgb = None
+    if extract_colors and sim:
+        white_rgb, white, depth = load_openexr_rgb_gray(data_path + "/" + file_pattern%0, load_depth)
+        if load_depth:
+            white = white, depth
+        if not kw.get("symmetric", True):
+            white = None  # Decoded from white.exr
+
+    all, groups = decode_single(data_path, save=save_decoded, group=group, file_pattern=file_pattern, preview=preview,
+                                undistort=undistort, undistort_mode=undistort_mode, load_depth=load_depth, white=white, **kw)
+    all, groups = as_saved_dtypes(all, groups)
 
-    return all_points, group_points, group_colors, group_depth_map/1000.0 if groups else None
+    # What decode_single writes to undistorted.txt and stride.txt
+    undistorted = undistort is not None and undistort_mode != "points"
+    stride = preview or 1
+
+    if save:
+        save_path = data_path + out_dir + "/"
+        ensure_exists(save_path)
+    else:
+        save_path = None
+
+    return reconstruct_decoded(all, groups, cam_calib, proj_calib, undistorted, stride, white_rgb, save_path, data_path,
+                               **(reconstruct_kw or {}))
+
+
+# Per position memory is estimated as for decode_many, which dominates the reconstruction memory
+def decode_reconstruct_many(path_template, cam_calib, proj_calib, suffix="gray/", n_jobs=1, ram_budget=None, **kw):
+    paths = glob.glob(path_template)
+    print("Found %d directories:" % len(paths), paths)
+
+    jobs = [joblib.delayed(decode_reconstruct_single)
+            (path + "/" + suffix, cam_calib, proj_calib, ram_budget=ram_budget, **kw) for path in paths]
+
+    frames = sorted(glob.glob(paths[0] + "/" + suffix + "*.exr"))[:1] if paths else []
+    per_task = task_bytes(frames, overhead=4 if kw.get("stream", False) else 8) if frames else None
+    results = run_parallel(jobs, per_task, ram_budget, n_jobs=n_jobs)
+
+    return {path: result for path, result in zip(paths, results)}
 
 
-def reconstruct_many(path_template, cam_calib, proj_calib, suffix="gray/", **kw):
+# Per position memory is estimated at ~64 bytes per camera pixel (points, normals, depth maps and temporaries)
+def reconstruct_many(path_template, cam_calib, proj_calib, suffix="gray/", n_jobs=8, ram_budget=None, **kw):
     paths = glob.glob(path_template)
     print("Found %d directories:" % len(paths), paths)
 
-    jobs = [joblib.delayed(reconstruct_single, check_pickle=False)
+    jobs = [joblib.delayed(reconstruct_single)
             (path + "/" + suffix, cam_calib, proj_calib, **kw) for path in paths]
 
-    results = joblib.Parallel(verbose=15, n_jobs=8, batch_size=1, pre_dispatch="all")(jobs)
+    decoded = (paths[0] + "/" + suffix + "decoded/mask.npy") if paths else None
+    per_task = npy_pixels_bytes(decoded, 64) if decoded and os.path.exists(decoded) else None
+    results = run_parallel(jobs, per_task, ram_budget, n_jobs=n_jobs)
 
     return {path: result for path, result in zip(paths, results)}
 
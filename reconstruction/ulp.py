@@ -0,0 +1,137 @@
+import os
+import glob
+import numpy as np
+from utils import load_openexr, load_ldr, ensure_exists, run_parallel, joblib
+from decode import DENSE_VALID, encode_dense, create_dense_correspondences
+
+
+# Decoder for the ULP pattern sets in data/patterns/ulp (captured with the ulp_* scan scripts). Every projector pixel
+# is identified by its vector of intensities over all patterns (the patterns are smooth 2D random textures, so the
+# code book has one entry per projector pixel). Each camera pixel is matched to the projector pixel with the highest
+# zero-mean normalized cross-correlation (ZNCC), which is invariant to the albedo and ambient light of the pixel.
+
+
+# ZNCC normalization along the last axis (zero mean, unit norm). Constant vectors become all zeros (score 0)
+def normalize_codes(codes):
+    codes = codes - np.mean(codes, axis=-1, keepdims=True)
+    norm = np.linalg.norm(codes, axis=-1, keepdims=True)
+    return np.divide(codes, norm, out=np.zeros_like(codes), where=norm > 0)
+
+
+# (proj_h, proj_w, num_patterns) float32 code book, normalized for matching
+def load_ulp_code_book(pattern_path):
+    patterns = sorted(glob.glob(pattern_path + "/*.png"))
+    codes = np.stack([load_ldr(pattern, make_gray=True) for pattern in patterns], axis=-1).astype(np.float32)
+    print("Loaded %d ULP patterns:" % len(patterns), codes.shape[:2])
+    return normalize_codes(codes)
+
+
+# Batched nearest neighbour search: for every row of cam_codes (n, F) the indices of the top_k rows of book (m, F) with
+# the highest scores (in no particular order, at most m of them). Blocks of camera pixels are scored against chunks of
+# the code book with one matrix multiply each, keeping only the running top_k. The (pixels x codes) float32 score
+# matrix and the int64 index matrix argpartition returns for it together never exceed block_bytes
+def match_codes(cam_codes, book, top_k=1, block_bytes=256*1024**2):
+    n, m = cam_codes.shape[0], book.shape[0]
+    top_k = min(top_k, m)
+    block = min(n, max(1, int(np.sqrt(block_bytes / 12))))
+    chunk = min(m, max(top_k, int(block_bytes // (12 * block))))
+
+    # Negated scores, so that the partitions pick the lowest values and the score matrix can be negated in place
+    best_idx, best_score = np.zeros((n, top_k), dtype=np.int64), np.full((n, top_k), np.inf, dtype=np.float32)
+    for i in range(0, n, block):
+        for j in range(0, m, chunk):
+            scores = np.matmul(cam_codes[i:i+block], book[j:j+chunk].T)
+            np.negative(scores, out=scores)
+            k = min(top_k, scores.shape[1])  # The last chunk may hold fewer than top_k codes
+            idx = np.argpartition(scores, k - 1, axis=1)[:, :k]
+            scores = np.concatenate([best_score[i:i+block], np.take_along_axis(scores, idx, axis=1)], axis=1)
+            idx = np.concatenate([best_idx[i:i+block], idx + j], axis=1)
+            keep = np.argpartition(scores, top_k - 1, axis=1)[:, :top_k]
+            best_idx[i:i+block], best_score[i:i+block] = np.take_along_axis(idx, keep, axis=1), np.take_along_axis(scores, keep, axis=1)
+
+    return best_idx, -best_score
+
+
+# Full resolution refinement of the coarse candidates (rows, cols), both (n, k): the best match in the
+# (2 * radius + 1)^2 neighbourhoods of all k candidates of each pixel. The gathered float32 codes and the int64 row /
+# column indices of the neighbourhoods never exceed block_bytes
+def refine_matches(cam_codes, codes, rows, cols, radius, block_bytes=256*1024**2):
+    dr, dc = np.mgrid[-radius:radius+1, -radius:radius+1]
+    dr, dc = dr.ravel(), dc.ravel()
+    block = max(1, int(block_bytes // ((4 * codes.shape[2] + 24) * rows.shape[1] * dr.shape[0])))
+
+    best_rows, best_cols = np.zeros(rows.shape[0], dtype=np.int64), np.zeros(rows.shape[0], dtype=np.int64)
+    best_score = np.zeros(rows.shape[0], dtype=np.float32)
+    for i in range(0, cam_codes.shape[0], block):
+        r = np.clip(rows[i:i+block, :, None] + dr[None, None, :], 0, codes.shape[0] - 1).reshape(-1, rows.shape[1] * dr.shape[0])
+        c = np.clip(cols[i:i+block, :, None] + dc[None, None, :], 0, codes.shape[1] - 1).reshape(r.shape)
+        scores = np.matmul(codes[r, c], cam_codes[i:i+block, :, None])[..., 0]
+        idx = np.argmax(scores, axis=1)
+        k = np.arange(idx.shape[0])
+        best_rows[i:i+block], best_cols[i:i+block], best_score[i:i+block] = r[k, idx], c[k, idx], scores[k, idx]
+
+    return best_rows, best_cols, best_score
+
+
+# Decodes the frames file_pattern % i (one per pattern in pattern_path) in data_path + folder into the dense
+# correspondence map of decode_single(dense=True), which reconstruct_single loads. The sensor is processed in bands of
+# band_rows rows by separate processes that memory-map a shared copy of the code book and only read the scanlines of
+# their band, so peak memory depends on the band size rather than the sensor size. Exhaustive matching against all projector
+# pixels is expensive, so by default the search runs on every proj_stride-th projector pixel first and is refined at
+# full resolution around the top_k coarse matches (proj_stride=1 for the exhaustive search). Matches with a ZNCC below
+# min_score are marked invalid
+def decode_ulp(data_path, pattern_path, folder="ulp_10/", out_dir="decoded", file_pattern="leo_%03d.exr",
+               proj_stride=2, top_k=4, min_score=0.8, band_rows=64, block_bytes=256*1024**2, n_jobs=-1, ram_budget=None):
+    save_path = data_path + "/" + out_dir + "/"
+    ensure_exists(save_path)
+
+    codes = load_ulp_code_book(pattern_path)
+    np.save(save_path + "ulp_code_book.npy", codes)
+    frames = [data_path + folder + file_pattern % i for i in range(codes.shape[2])]
+    shape = load_openexr(frames[0], single_channel=True, half=True).shape
+    del codes
+
+    create_dense_correspondences(save_path, shape)
+    np.lib.format.open_memmap(save_path + "mask.npy", mode="w+", dtype=np.bool_, shape=shape)
+    with open(save_path + "undistorted.txt", "w") as f:
+        f.write(str(False))  # Correspondences are in raw sensor space
+
+    # The band of all frames (raw and normalized) plus the matching blocks (match_codes and refine_matches keep their
+    # temporaries within block_bytes each)
+    band_bytes = 2 * len(frames) * band_rows * shape[1] * 4 + 2 * block_bytes
+    jobs = [joblib.delayed(decode_ulp_band)(frames, save_path, r0, min(r0 + band_rows, shape[0]),
+            proj_stride, top_k, min_score, block_bytes) for r0 in range(0, shape[0], band_rows)]
+    counts = run_parallel(jobs, band_bytes, ram_budget, n_jobs)
+    os.remove(save_path + "ulp_code_book.npy")
+
+    print("Decoded %d of %d pixels" % (sum(counts), shape[0] * shape[1]))
+    return save_path
+
+
+def decode_ulp_band(frames, save_path, r0, r1, proj_stride, top_k, min_score, block_bytes):
+    codes = np.load(save_path + "ulp_code_book.npy", mmap_mode="r")
+    corr = np.load(save_path + "correspondences.npy", mmap_mode="r+")
+    mask = np.load(save_path + "mask.npy", mmap_mode="r+")
+
+    cam_codes = np.zeros((r1 - r0, corr.shape[1], len(frames)), dtype=np.float32)
+    for i, frame in enumerate(frames):
+        cam_codes[..., i] = load_openexr(frame, single_channel=True, half=True, rows=(r0, r1))
+    cam_codes = normalize_codes(cam_codes.reshape(-1, len(frames)))
+
+    book = np.ascontiguousarray(codes[::proj_stride, ::proj_stride])
+    idx, score = match_codes(cam_codes, book.reshape(-1, book.shape[2]), 1 if proj_stride == 1 else top_k, block_bytes)
+    rows, cols = (idx // book.shape[1]) * proj_stride, (idx % book.shape[1]) * proj_stride
+    if proj_stride > 1:
+        rows, cols, score = refine_matches(cam_codes, codes, rows, cols, proj_stride // 2 + 1, block_bytes)
+    else:
+        rows, cols, score = rows[:, 0], cols[:, 0], score[:, 0]
+
+    q, valid = encode_dense(np.stack([cols, rows], axis=1))
+    valid &= score >= min_score
+    corr[r0:r1, :, 0] = np.where(valid, q[:, 0] | DENSE_VALID, 0).reshape(r1 - r0, -1)
+    corr[r0:r1, :, 1] = np.where(valid, q[:, 1], 0).reshape(r1 - r0, -1)
+    mask[r0:r1] = valid.reshape(r1 - r0, -1)
+    corr.flush()
+    mask.flush()
+
+    return np.count_nonzero(valid)
@@ -64,9 +64,8 @@ def undistort_images(images_path, cam_calib):
     ensure_exists(images_path + "undistorted/")
     print("Found %d images:" % len(images), images)
 
-    for image in images:
-        original = load_openexr(image)
-        undistorted = cv2.undistort(original, cam_calib["mtx"], cam_calib["dist"], newCameraMatrix=cam_calib["new_mtx"])
+    for image, original in zip(images, prefetch(load_openexr, [(image,) for image in images])):
+        undistorted = undistort_image(original, cam_calib)
         new_filename = images_path + "undistorted/" + os.path.basename(image)
         save_openexr(new_filename, undistorted)
         print(new_filename)
@@ -62,18 +62,20 @@ def process_checkers(checker_path, planes, projector_calib, plot=False):
 
 
 def crop_single(camera_filename, projector_filename, corners, y_off=300, x_pad=0, y_pad=30, size=150, id=0, plot=False, **kw):
-    cam = load_openexr(camera_filename, make_gray=True)
-    proj = load_openexr(projector_filename, make_gray=True)
+    # Only the rows of the camera strip and the range of rows covered by the projector crops are read
+    y_off = y_off - id * 2  # avoid a spec of dust
+    cam = load_openexr(camera_filename, make_gray=True, single_channel=True, rows=(y_off, y_off+10))
+    r0 = max(0, int(np.min(corners[..., 1])) + y_pad)
+    proj = load_openexr(projector_filename, make_gray=True, single_channel=True, rows=(r0, int(np.max(corners[..., 1])) + y_pad + size))
     print("Loaded:", camera_filename, "and", projector_filename)
 
-    y_off = y_off - id * 2  # avoid a spec of dust
-    cam_crop = np.average(cam[y_off:y_off+10, cam. shape[1]//2: cam.shape[1]//2 + 400], axis=0)
+    cam_crop = np.average(cam[:, cam. shape[1]//2: cam.shape[1]//2 + 400], axis=0)
 
     proj_crops = np.zeros((8, 17, size, size))
     for i in range(8):
         for j in range(17):
             c = corners[i, j, :].astype(np.int)
-            proj_crops[i, j, :, :] = proj[c[1]+y_pad:c[1]+y_pad+size, c[0]+x_pad:c[0]+x_pad+size]
+            proj_crops[i, j, :, :] = proj[c[1]+y_pad-r0:c[1]+y_pad-r0+size, c[0]+x_pad:c[0]+x_pad+size]
 
     if plot:
         plt.figure("Camera Profile(s)")
@@ -88,7 +90,7 @@ def crop_single(camera_filename, projector_filename, corners, y_off=300, x_pad=0
 
 
 def crop_many(camera_template, projector_template, ids, corners, out_dir=None, save=True, **kw):
-    jobs = [joblib.delayed(crop_single, check_pickle=False)
+    jobs = [joblib.delayed(crop_single)
             (camera_template % id, projector_template % id, corners[id, ...], id=id, **kw) for id in ids]
 
     results = joblib.Parallel(verbose=15, n_jobs=-1, batch_size=1, pre_dispatch="all")(jobs)
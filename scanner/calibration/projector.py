@@ -323,15 +323,17 @@ def calibrate_response(data_path, cache=True, save=False, plot=False, save_figur
 
     def process_single(filename, id, plot=False):
         print("Loading %d:" % id, filename)
-        img = load_openexr(filename)
+        # Only the rows of the three patches are decompressed
+        patch = lambda r, c: load_openexr(filename, single_channel=True, rows=(r, r + 50), cols=(c, c + 50))
 
-        ambient = np.average(img[100:150, 5000:5050])
-        parasitic = np.average(img[1000:1050, 3250:3300])
-        signal = np.average(img[2000:2050, 3250:3300])
+        ambient = np.average(patch(100, 5000))
+        parasitic = np.average(patch(1000, 3250))
+        signal = np.average(patch(2000, 3250))
 
         print(id, "-", ambient, parasitic, signal)
 
         if plot:
+            img = load_openexr(filename, single_channel=True)
             m = np.max(img)
             img[100:150, 5000:5050] = m
             img[1000:1050, 3250:3300] = m
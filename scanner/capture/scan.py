@@ -218,6 +218,9 @@ if __name__ == "__main__":
     # hdr_exposures = [0.0167, 0.0333, 0.05, 0.1, 0.25, 0.75]
     hdr_exposures = [0.0167, 0.0333, 0.05, 0.1, 0.25, 0.75, 1.5]
     ldr_exposure = 0.5
+    # save_openexr options for HDRs, see utils/benchmark_exr.py. E.g. {"compression": "NONE", "single_channel": True}
+    # writes fastest during capture, the default (PXR24, RGB) matches the archived scans
+    hdr_options = {}
 
     ldr, hdr, ldr_name, hdr_name = None, None, None, None
     ldr_count, hdr_count = 0, 0
@@ -259,7 +262,7 @@ if __name__ == "__main__":
                     if not os.path.exists(data_path + prefix + suffix):
                         os.makedirs(data_path + prefix + suffix, exist_ok=True)
 
-                    save_openexr(data_path + prefix + suffix + hdr_name + ".exr", hdr.result())
+                    save_openexr(data_path + prefix + suffix + hdr_name + ".exr", hdr.result(), **hdr_options)
                     hdr_count += 1
                     hdr = None
                 else:
@@ -33,16 +33,24 @@ def simulate_teaser_figure(data_path, mitsuba_path, pawn_geometry, verbose=True,
 
 def analyze_teaser_figure(data_path, lim=1.03, thr=0.05, roi=True, crop=False, hist=False, save=False):
     data_path += "/"
-    render = load_openexr(data_path + "rendered.exr")
-    clean = load_openexr(data_path + "captured.exr")
+    l, r, t, b = 2000, 4250, 900, 3700
+    cl, cr, ct, cb = 2750, 3250, 2725, 3050
+    nt, nl, ns = 1425, 3200, 50
+
+    # With roi the thresholds come from a patch inside the [t:b, l:r] window, so only that window is read and all
+    # coordinates below are relative to its corner (y0, x0). Otherwise thresholds are taken from the full images
+    window = {"rows": (t, b), "cols": (l, r)} if roi else {}
+    y0, x0 = (t, l) if roi else (0, 0)
+    render = load_openexr(data_path + "rendered.exr", **window)
+    clean = load_openexr(data_path + "captured.exr", **window)
     print("Loaded")
 
     mask = render > 1.e-6
     clean[~mask] = 0
 
-    l, r, t, b = 2000, 4250, 900, 3700
-    cl, cr, ct, cb = 2750, 3250, 2725, 3050
-    nt, nl, ns = 1425, 3200, 50
+    l, r, t, b = l - x0, r - x0, t - y0, b - y0
+    cl, cr, ct, cb = cl - x0, cr - x0, ct - y0, cb - y0
+    nt, nl = nt - y0, nl - x0
 
     if roi:
         render_thr = np.average(render[nt:(nt+ns), nl:(nl+ns)])
@@ -93,8 +101,8 @@ def analyze_teaser_figure(data_path, lim=1.03, thr=0.05, roi=True, crop=False, h
 
         if crop:
             img = np.dstack([clean_lm] * 3)
-            cv2.rectangle(img, (2850, 2780), (2950, 2880), (0, 0, 255), thickness=2)
-            cv2.putText(img, "6.5mm", (2960, 2840), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255), 2, cv2.LINE_AA)
+            cv2.rectangle(img, (2850 - x0, 2780 - y0), (2950 - x0, 2880 - y0), (0, 0, 255), thickness=2)
+            cv2.putText(img, "6.5mm", (2960 - x0, 2840 - y0), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255), 2, cv2.LINE_AA)
             cv2.imwrite(data_path + "plots/0_clean_crop.png", img[ct:cb, cl:cr])
 
             # cv2.imwrite(data_path + "plots/0_clean_crop.png", clean_lm[ct:cb, cl:cr])
@@ -131,12 +139,12 @@ def analyze_teaser_figure(data_path, lim=1.03, thr=0.05, roi=True, crop=False, h
         plot_hist("Crop", diff, bins=1000, range=[-0.5, 0.5],
                   title="Diff (std=%.3f)" % np.std(diff), semilog=True)
 
-        row, col, sz = 2800, 3000, 50
+        row, col, sz = 2800 - y0, 3000 - x0, 50
         diff = (render - clean)[row:row + sz, col:col + sz].ravel()
         plot_hist("Patch", diff, bins=500, range=[-0.1, 0.1],
                   title="Diff Patch (mean=%.3f, std=%.3f)" % (np.mean(diff), np.std(diff)))
 
-        row, col, sz = 2825, 3200, 20
+        row, col, sz = 2825 - y0, 3200 - x0, 20
         noise = clean[row:row + sz, col:col + sz].ravel()
         plot_hist("Noise", noise - np.mean(noise), bins=500, range=[-0.003, 0.003],
                   title="Noise (level=%.6f, std=%.6f)" % (np.mean(noise), np.std(noise)))
@@ -1,5 +1,7 @@
+from .lazy import *
 from .utils import *
 from .process import *
 from .hdr import *
 from .calibrate import *
-from .detect import *
\ No newline at end of file
+from .detect import *
+from .parallel import *
\ No newline at end of file
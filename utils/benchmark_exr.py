@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from utils import *
+
+
+# Write / read throughput and file size of the save_openexr modes, to pick the settings for capture (speed) versus
+# archive (size). Frames are read back the way the decoders do (single channel, keeping HALF). float24 marks float32
+# frames written with PXR24, which truncates them to 24 bits.
+# Usage: python benchmark_exr.py [image.exr] - a synthetic 6464x4852 gray frame is used without an image
+default_modes = [dict(compression=compression, single_channel=single_channel, half=half)
+                 for half in [True, False] for single_channel in [False, True]
+                 for compression in ["NONE", "ZIP", "PIZ", "PXR24"]]
+
+
+# Stripes with shading and noise, roughly what a structured light capture looks like
+def synthetic_frame(shape=(4852, 6464), period=64, seed=0):
+    rng = np.random.default_rng(seed)
+    r, c = np.mgrid[:shape[0], :shape[1]].astype(np.float32)
+    shading = 0.2 + 0.8 * np.exp(-((r / shape[0] - 0.5)**2 + (c / shape[1] - 0.5)**2) * 4)
+    stripes = ((c // period) % 2).astype(np.float32)
+    return (shading * (0.05 + 0.5 * stripes) + 0.005 * rng.standard_normal(shape)).astype(np.float32)
+
+
+def benchmark_openexr(image, modes=default_modes, repeats=3, path=None):
+    filename = (path or tempfile.mkdtemp()) + "/benchmark.exr"
+    mb = image.shape[0] * image.shape[1] * 4 / 1024**2  # as a float32 gray image
+
+    results = []
+    for mode in modes:
+        write, read = np.inf, np.inf
+        for i in range(repeats):
+            start = time.time()
+            save_openexr(filename, image, **mode)
+            write = min(write, time.time() - start)
+
+            start = time.time()
+            load_openexr(filename, single_channel=True, half=mode["half"])
+            read = min(read, time.time() - start)
+
+        size = os.path.getsize(filename) / 1024**2
+        results.append(dict(mode, write=mb / write, read=mb / read, size=size))
+        print("%-5s %-6s %-7s write %7.1f MB/s, read %7.1f MB/s, size %7.1f MB" %
+              (mode["compression"], "single" if mode["single_channel"] else "rgb", "half" if mode["half"] else
+              "float24" if mode["compression"] == "PXR24" else "float",
+               mb / write, mb / read, size))
+
+    os.remove(filename)
+    return results
+
+
+if __name__ == "__main__":
+    image = load_openexr(sys.argv[1], single_channel=True) if len(sys.argv) > 1 else synthetic_frame()
+    print("Image:", image.shape)
+
+    benchmark_openexr(image)
@@ -0,0 +1,38 @@
+import os
+import sys
+import subprocess
+
+
+# Cold import time of the pipeline modules, each measured in a fresh interpreter started in reconstruction/ (as the
+# pipeline scripts and their joblib workers are). Heavy
+# dependencies are deferred with lazy.py, so these should stay well below the time for importing matplotlib, sklearn
+# and scipy.optimize eagerly. Usage: python benchmark_imports.py [module ...] [--importtime]
+# --importtime prints the 15 slowest imports per module from python -X importtime
+default_modules = ["utils", "decode", "reconstruct", "mps", "ulp"]
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module, repeats=3, importtime=False):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root + "/utils", root + "/reconstruction",
+                                                       os.environ.get("PYTHONPATH", "")]))
+    cwd = root + "/reconstruction"
+    code = "import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)" % module
+
+    best = min(float(subprocess.check_output([sys.executable, "-c", code], env=env, cwd=cwd).decode().split()[-1])
+               for i in range(repeats))
+
+    if importtime:
+        log = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], env=env,
+                             cwd=cwd, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL).stderr.decode()
+        rows = [line.split("|") for line in log.splitlines() if line.startswith("import time:") and "[us]" not in line]
+        rows = sorted(rows, key=lambda row: -int(row[1]))[:15]
+        for row in rows:
+            print("    %8.1f ms  %s" % (int(row[1]) / 1000, row[2].strip()))
+
+    return best
+
+
+if __name__ == "__main__":
+    modules = [arg for arg in sys.argv[1:] if not arg.startswith("--")] or default_modules
+    for module in modules:
+        print("%-12s %.3f s" % (module, import_time(module, importtime="--importtime" in sys.argv)))
@@ -3,7 +3,7 @@ import pickle
 
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
+from lazy import *
 
 
 # Duplicate from detect.py in scanner
@@ -1,7 +1,6 @@
 import os
 import glob
 import json
-import joblib
 import cv2
 from cv2 import aruco
 # print(cv2.__version__)
@@ -125,13 +124,13 @@ def detect_single(filename, detect_func, resize=1, out_dir="detected", draw=Fals
 
 
 # Process all images that match a filename_template. Save valid results as json file if need be
-def detect_all(filename_template, detect_func, out_dir="detected", save_json=True, **kw):
+def detect_all(filename_template, detect_func, out_dir="detected", save_json=True, ram_budget=None, **kw):
     filenames = glob.glob(filename_template)
 
     jobs = [joblib.delayed(detect_single)
             (name, detect_func, return_image=False, out_dir=out_dir, **kw) for name in filenames]
 
-    results = joblib.Parallel(verbose=15, n_jobs=-1, batch_size=1, pre_dispatch="all")(jobs)
+    results = run_parallel(jobs, task_bytes(filenames[:1], overhead=4) if filenames else None, ram_budget)
 
     ret = {}
     for filename, result in zip(filenames, results):
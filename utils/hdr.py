@@ -1,13 +1,15 @@
 import json
 import Imath
 import OpenEXR
-import imageio
 import scipy
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import optimize
-import scipy.ndimage.morphology as morph
-from scipy.ndimage.filters import gaussian_filter
+from lazy import *
+
+imageio = LazyModule("imageio")
+optimize = LazyModule("scipy.optimize")
+ndimage = LazyModule("scipy.ndimage")
+morph = LazyModule("scipy.ndimage.morphology")
+gaussian_filter = LazyObject("scipy.ndimage.filters", "gaussian_filter")
 
 eps = 1e-8
 default_gamma = 1.0078
@@ -257,7 +259,7 @@ def compute_hdr_replace(exposures, images, plot=False):
         # mask = res > thr
         mask_g = gaussian_filter(res, 1) > thr
 
-        struct = scipy.ndimage.generate_binary_structure(2, 1)
+        struct = ndimage.generate_binary_structure(2, 1)
         mask_e = morph.binary_erosion(mask_g, struct, 1)
         mask_dd = morph.binary_dilation(mask_e, struct, 2)
 
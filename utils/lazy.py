@@ -0,0 +1,59 @@
+import importlib
+import types
+
+
+# Stand-ins for heavy dependencies that are only imported on first use. Module level names like plt or PCA keep working
+# (including for "from utils import *" users), while processes that never touch them, e.g. joblib workers that only
+# load images, skip importing them
+
+
+# Module imported on first attribute access. on_import(module) runs once right after the import
+class LazyModule(types.ModuleType):
+    def __init__(self, name, on_import=None):
+        super().__init__(name)
+        self._on_import = on_import
+
+    # Only called for attributes that are not set yet, i.e. until the module is imported
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        on_import = self.__dict__.pop("_on_import", None)
+        if on_import is not None:
+            on_import(module)
+
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+# Function or class attr of module, imported on first call or attribute access
+class LazyObject:
+    def __init__(self, module, attr):
+        self._module, self._attr = module, attr
+
+    def _resolve(self):
+        return getattr(importlib.import_module(self._module), self._attr)
+
+    def __call__(self, *args, **kw):
+        return self._resolve()(*args, **kw)
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return "<lazy %s.%s>" % (self._module, self._attr)
+
+
+# Shared matplotlib stand-ins. The backend is left to matplotlib (or MPLBACKEND), which falls back to Agg on headless
+# nodes instead of failing like a forced TkAgg
+# font = {'family': 'serif', 'weight': 'normal', 'size': 32}
+font = {'weight': 'normal', 'size': 14}
+_matplotlib_configured = []
+
+
+def _configure_matplotlib(module):
+    if not _matplotlib_configured:
+        _matplotlib_configured.append(True)
+        importlib.import_module("matplotlib").rc('font', **font)
+
+
+matplotlib = LazyModule("matplotlib", on_import=_configure_matplotlib)
+plt = LazyModule("matplotlib.pyplot", on_import=_configure_matplotlib)
@@ -0,0 +1,108 @@
+import os
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from lazy import LazyModule
+
+joblib = LazyModule("joblib")
+
+
+# Shared scheduling for joblib stages: instead of n_jobs=-1, cap concurrency so that the estimated memory of all
+# tasks in flight fits into a RAM budget. Budget (in GB) can be set with the SCANNER_RAM_BUDGET environment variable,
+# by default it is ram_fraction of the physical memory (no cap if that can not be determined on this platform)
+def get_ram_budget(ram_fraction=0.7):
+    budget = os.environ.get("SCANNER_RAM_BUDGET")
+    if budget:
+        return float(budget) * 1024**3
+
+    try:
+        return ram_fraction * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        pass
+
+    try:
+        import psutil
+        return ram_fraction * psutil.virtual_memory().total
+    except ImportError:
+        return None
+
+
+# Size in bytes of a decoded image, read from its header only: EXR dataWindow x channels x 4 (loaded as FLOAT),
+# LDR width x height x bands x 1. Unknown formats fall back to the file size
+def image_bytes(filename):
+    if filename.lower().endswith(".exr"):
+        import OpenEXR
+        exr = OpenEXR.InputFile(filename)
+        try:
+            header = exr.header()
+            dw = header["dataWindow"]
+            return (dw.max.y - dw.min.y + 1) * (dw.max.x - dw.min.x + 1) * len(header["channels"]) * 4
+        finally:
+            exr.close()
+
+    try:
+        from PIL import Image
+        with Image.open(filename) as img:
+            return img.width * img.height * len(img.getbands())
+    except Exception:
+        return os.path.getsize(filename)
+
+
+# Rough peak memory of a task that loads filenames at the same time. overhead accounts for temporaries (channel
+# buffers while loading, conversions, intermediate results) relative to the decoded images themselves
+def task_bytes(filenames, overhead=2.0):
+    if type(filenames) is str:
+        filenames = [filenames]
+    return int(overhead * sum(image_bytes(filename) for filename in filenames))
+
+
+# Bytes of an (H, W) stage given per pixel cost, with H, W taken from the header of an .npy file (no data is loaded)
+def npy_pixels_bytes(filename, bytes_per_pixel):
+    shape = np.load(filename, mmap_mode="r").shape
+    return int(np.prod(shape[:2]) * bytes_per_pixel)
+
+
+def admit_n_jobs(per_task_bytes=None, ram_budget=None, n_jobs=-1, verbose=True):
+    n_cpus = joblib.cpu_count()
+    n_jobs = n_cpus + 1 + n_jobs if n_jobs < 0 else min(n_jobs, n_cpus)
+
+    ram_budget = ram_budget or get_ram_budget()
+    if not per_task_bytes or not ram_budget:
+        return max(1, n_jobs)
+
+    admitted = max(1, min(n_jobs, int(ram_budget // per_task_bytes)))
+    if verbose and admitted < n_jobs:
+        print("Running %d instead of %d jobs at a time: %.1f GB per task, %.1f GB budget" %
+              (admitted, n_jobs, per_task_bytes / 1024**3, ram_budget / 1024**3))
+
+    return admitted
+
+
+# Drop-in for joblib.Parallel(verbose=15, n_jobs=-1, batch_size=1, pre_dispatch="all")(jobs) with admission control
+def run_parallel(jobs, per_task_bytes=None, ram_budget=None, n_jobs=-1, verbose=15):
+    n_jobs = admit_n_jobs(per_task_bytes, ram_budget, n_jobs)
+
+    return joblib.Parallel(verbose=verbose, n_jobs=n_jobs, batch_size=1, pre_dispatch="2*n_jobs")(jobs)
+
+
+# Ordered read-ahead for multi-frame stages: yields func(*args, **kw) for every args in args_list, in order, while the
+# next depth calls already run on background threads. At most depth + 1 results are alive at a time, so loading
+# (file I/O, EXR decompression) of the following frames overlaps with whatever the consumer does with the current one
+def prefetch(func, args_list, depth=2, **kw):
+    args_list = iter(args_list)
+
+    with ThreadPoolExecutor(max_workers=max(1, depth)) as pool:
+        queue = collections.deque()
+
+        def submit():
+            for args in args_list:
+                queue.append(pool.submit(func, *args, **kw))
+                return
+
+        for i in range(max(1, depth)):
+            submit()
+
+        while queue:
+            result = queue.popleft().result()
+            submit()
+            yield result
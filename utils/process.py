@@ -1,6 +1,5 @@
 from detect import *
 from shutil import copyfile
-import matplotlib.pyplot as plt
 
 
 def linear_map(img, thr=None, mask=None, gamma=1.0):
@@ -36,7 +35,7 @@ def tone_map(img, thr=None, mask=None):
 def map_single(filename, method=None, return_image=True, is_gray=True, suffix="", save=False, plot=False):
     assert(method is not None)
 
-    img = load_openexr(filename, make_gray=is_gray)  # our HDRs always have 3 channels (even for gray scale images)
+    img = load_openexr(filename, make_gray=is_gray, single_channel=is_gray)  # our HDRs always have 3 channels (even for gray scale images)
     print("Loaded", filename)
 
     ldr, thr = method(img)
@@ -62,25 +61,25 @@ def map_single(filename, method=None, return_image=True, is_gray=True, suffix=""
     return ldr if return_image else None, new_filename
 
 
-def map_all(filename_template, method, return_images=True, **kw):
+def map_all(filename_template, method, return_images=True, ram_budget=None, **kw):
     filenames = glob.glob(filename_template)
 
     jobs = [joblib.delayed(map_single)
             (filename, method=method, return_image=return_images, **kw) for filename in filenames]
 
-    return joblib.Parallel(verbose=15, n_jobs=-1, batch_size=1, pre_dispatch="all")(jobs)
+    return run_parallel(jobs, task_bytes(filenames[:1]) if filenames else None, ram_budget)
 
 
 # Process a charuco-checker calibration pair. Extract clean checker image projected onto a charuco board
 def process_single(image_filename, blank_filename, texture_filename, auto_map=None, out_dir="processed", return_image=True, are_gray=True, save=False, plot=False):
-    image = load_openexr(image_filename, make_gray=are_gray)
-    blank = load_openexr(blank_filename, make_gray=are_gray)
+    image = load_openexr(image_filename, make_gray=are_gray, single_channel=are_gray)
+    blank = load_openexr(blank_filename, make_gray=are_gray, single_channel=are_gray)
     clean = np.maximum(0, image - blank)
 
     print("Loaded", image_filename)
 
     if texture_filename is not None:
-        texture = load_openexr(texture_filename, make_gray=are_gray)
+        texture = load_openexr(texture_filename, make_gray=are_gray, single_channel=are_gray)
         texture = np.maximum(0, texture - blank)
         texture_ldr, texture_thr = linear_map(texture)
         mask = texture > texture_thr * 0.002
@@ -117,7 +116,7 @@ def process_single(image_filename, blank_filename, texture_filename, auto_map=No
     return processed if return_image else None, new_filename
 
 
-def process_all(image_template, blank_template, texture_template, auto_map=None, out_dir="processed", return_images=True, **kw):
+def process_all(image_template, blank_template, texture_template, auto_map=None, out_dir="processed", return_images=True, ram_budget=None, **kw):
     images = glob.glob(image_template)
     blanks = glob.glob(blank_template)
     textures = glob.glob(texture_template) if texture_template is not None else [None] * len(images)
@@ -126,7 +125,8 @@ def process_all(image_template, blank_template, texture_template, auto_map=None,
             (image, blank, texture, auto_map=auto_map, out_dir=out_dir, return_image=return_images, **kw)
             for image, blank, texture in zip(images, blanks, textures)]
 
-    return joblib.Parallel(verbose=15, n_jobs=-1, batch_size=1, pre_dispatch="all")(jobs)
+    per_task = task_bytes([f for f in (images[0], blanks[0], textures[0]) if f is not None]) if images else None
+    return run_parallel(jobs, per_task, ram_budget)
 
 
 # Analyse one image from the stage calibration data
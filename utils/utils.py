@@ -1,4 +1,7 @@
 import itertools
+import functools
+import collections
+import threading
 import os
 import cv2
 import glob
@@ -9,19 +12,15 @@ import shutil
 import OpenEXR
 import subprocess
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from sklearn.decomposition import PCA
-from scipy.optimize import least_squares
-import meshio
-import open3d as o3d
-import imageio
+from lazy import *
+from parallel import *
 
-import matplotlib
-matplotlib.use('TkAgg')
-# font = {'family': 'serif', 'weight': 'normal', 'size': 32}
-font = {'weight': 'normal', 'size': 14}
-matplotlib.rc('font', **font)
+# Heavy dependencies are imported on first use (matplotlib and plt come from lazy.py, see also benchmark_imports.py)
+PCA = LazyObject("sklearn.decomposition", "PCA")
+least_squares = LazyObject("scipy.optimize", "least_squares")
+meshio = LazyModule("meshio")
+o3d = LazyModule("open3d")
+imageio = LazyModule("imageio")
 
 
 class NumpyEncoder(json.JSONEncoder):
@@ -93,6 +92,7 @@ def plot_hist(data, figure_name, title=None, size=(12, 12), save_as=None, **kw):
 
 
 def plot_3d(points, figure_name, title=None, size=(12, 9), axis_equal=True, save_as=None, **kw):
+    from mpl_toolkits.mplot3d import Axes3D  # registers the 3d projection
     plt.figure(figure_name, size)
     plt.clf()
     ax = plt.subplot(111, projection='3d', proj_type='ortho')
@@ -142,26 +142,40 @@ def replace_hot_pixels(img, dark, thr=32):
 
 
 # Gray scale by default
-def save_openexr(filename, image, keep_rgb=False):
+# Gray images are written as identical R, G and B HALF channels with PXR24 compression by default (to keep them
+# readable by LuminanceHDR). single_channel=True writes them as a single Y channel instead (a third of the data,
+# load_openexr reads both layouts). compression is one of "NONE", "ZIP", "PIZ" or "PXR24" (lossy for float32) and
+# half=False writes float32 channels, losslessly with ZIP unless compression is given. See benchmark_exr.py for the
+# speed / size trade-off of these modes
+def save_openexr(filename, image, keep_rgb=False, compression=None, single_channel=False, half=True):
+    dtype, pixel_type = (np.float16, OpenEXR.HALF) if half else (np.float32, OpenEXR.FLOAT)
+    compression = compression or ("PXR24" if half else "ZIP")
+
     if len(image.shape) > 2:
         if keep_rgb:
-            R = image[:, :, 0].astype(np.float16).tobytes()
-            G = image[:, :, 1].astype(np.float16).tobytes()
-            B = image[:, :, 2].astype(np.float16).tobytes()
+            R = image[:, :, 0].astype(dtype).tobytes()
+            G = image[:, :, 1].astype(dtype).tobytes()
+            B = image[:, :, 2].astype(dtype).tobytes()
         else:
-            R = G = B = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).astype(np.float16).tobytes()
+            R = G = B = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).astype(dtype).tobytes()
+    else:
+        R = G = B = image.astype(dtype).tobytes()
+
+    if single_channel and not (keep_rgb and len(image.shape) > 2):
+        pixels = {'Y': G}
     else:
-        R = G = B = image.astype(np.float16).tobytes()
+        pixels = {'R': R, 'G': G, 'B': B}   # need to duplicate channels for grayscale anyways
+                                            # (to keep it readable by LuminanceHDR)
 
     header = OpenEXR.Header(image.shape[1], image.shape[0])
-    header['Compression'] = Imath.Compression(Imath.Compression.PXR24_COMPRESSION)
-    header['channels'] = {'R': Imath.Channel(Imath.PixelType(OpenEXR.HALF)),
-                          'G': Imath.Channel(Imath.PixelType(OpenEXR.HALF)),
-                          'B': Imath.Channel(Imath.PixelType(OpenEXR.HALF))}
+    header['compression'] = Imath.Compression({"NONE": Imath.Compression.NO_COMPRESSION,
+                                               "ZIP": Imath.Compression.ZIP_COMPRESSION,
+                                               "PIZ": Imath.Compression.PIZ_COMPRESSION,
+                                               "PXR24": Imath.Compression.PXR24_COMPRESSION}[compression.upper()])
+    header['channels'] = {name: Imath.Channel(Imath.PixelType(pixel_type)) for name in pixels}
 
     exr = OpenEXR.OutputFile(filename, header)
-    exr.writePixels({'R': R, 'G': G, 'B': B})   # need to duplicate channels for grayscale anyways
-                                                # (to keep it readable by LuminanceHDR)
+    exr.writePixels(pixels)
     exr.close()
 
 
@@ -186,35 +200,137 @@ def save_openexr(filename, image, keep_rgb=False):
 #         finally:
 #             in_file.close()
 
-# Gray scale by default
-def load_openexr(filename, make_gray=True, load_depth=False):
+# Opt-in, process-wide LRU cache for load_openexr and load_ldr, for runs (and notebooks) that load the same images
+# repeatedly. Entries are keyed by the loader, absolute path, modification time, file size and loader arguments, so a
+# file that changes on disk is loaded again. Least recently used entries are evicted once the cached images exceed
+# max_bytes. Callers always get copies, so modifying a returned image does not affect the cache. Disabled by default,
+# enable with enable_image_cache() or the SCANNER_IMAGE_CACHE environment variable (in GB)
+_image_cache = collections.OrderedDict()
+_image_cache_lock = threading.Lock()
+_image_cache_info = {"max_bytes": int(float(os.environ.get("SCANNER_IMAGE_CACHE", 0)) * 1024**3),
+                     "bytes": 0, "hits": 0, "misses": 0}
+
+
+def enable_image_cache(max_gb=4.0):
+    _image_cache_info["max_bytes"] = int(max_gb * 1024**3)
+    _evict_images()
+
+
+def disable_image_cache():
+    _image_cache_info["max_bytes"] = 0
+    clear_image_cache()
+
+
+def clear_image_cache():
+    with _image_cache_lock:
+        _image_cache.clear()
+        _image_cache_info["bytes"] = 0
+
+
+# Hit / miss counters, cached bytes and number of entries
+def image_cache_info():
+    with _image_cache_lock:
+        return dict(_image_cache_info, entries=len(_image_cache))
+
+
+def _evict_images():
+    with _image_cache_lock:
+        while _image_cache and _image_cache_info["bytes"] > _image_cache_info["max_bytes"]:
+            _image_cache_info["bytes"] -= _image_cache.popitem(last=False)[1][1]
+
+
+def _copy_images(images):
+    if type(images) is tuple:
+        return tuple(_copy_images(image) for image in images)
+    return images.copy() if images is not None else None
+
+
+def cached_images(loader):
+    @functools.wraps(loader)
+    def cached_loader(filename, *args, **kw):
+        if not _image_cache_info["max_bytes"]:
+            return loader(filename, *args, **kw)
+
+        stat = os.stat(filename)
+        key = (loader.__name__, os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, args, tuple(sorted(kw.items())))
+
+        with _image_cache_lock:
+            entry = _image_cache.get(key)
+            if entry is not None:
+                _image_cache.move_to_end(key)
+                _image_cache_info["hits"] += 1
+            else:
+                _image_cache_info["misses"] += 1
+        if entry is not None:
+            return _copy_images(entry[0])
+
+        images = loader(filename, *args, **kw)
+        size = sum(image.nbytes for image in (images if type(images) is tuple else (images,)) if image is not None)
+        if size <= _image_cache_info["max_bytes"]:
+            with _image_cache_lock:
+                if key not in _image_cache:
+                    _image_cache[key] = images, size
+                    _image_cache_info["bytes"] += size
+            _evict_images()
+
+        return _copy_images(images)
+
+    return cached_loader
+
+
+# Gray scale by default. Gray scans saved with save_openexr(single_channel=True) have a single Y channel, which is
+# returned as is (repeated to RGB for make_gray=False). Otherwise save_openexr writes them as identical R=G=B, and
+# single_channel=True reads only the G channel of those (a third of the decompression; returned as HxW even with
+# make_gray=False). Simulated renders have a real color.R/G/B layout, so they are still converted from all three.
+# half=True keeps channels stored as HALF (our scans) in float16 instead of converting them to float32. FLOAT channels
+# (and depth) stay float32. rows=(r0, r1) and cols=(c0, c1) return only that window of the image (half-open, relative
+# to the data window). Only the scanline blocks of the rows are decompressed, columns are cropped after reading
+@cached_images
+def load_openexr(filename, make_gray=True, load_depth=False, single_channel=False, half=False, rows=None, cols=None):
     with open(filename, "rb") as f:
         in_file = OpenEXR.InputFile(f)
         try:
-            dw = in_file.header()['dataWindow']
-            pt = Imath.PixelType(Imath.PixelType.FLOAT)
+            header = in_file.header()
+            dw = header['dataWindow']
             dim = (dw.max.y - dw.min.y + 1, dw.max.x - dw.min.x + 1)
             # print(dim)
-            if len(in_file.header()['channels']) == 3:  # Scan
-                (r, g, b) = in_file.channels("RGB", pixel_type=pt)
+            r0, r1 = rows if rows is not None else (0, dim[0])
+            r1 = min(r1, dim[0])
+            c0, c1 = cols if cols is not None else (0, dim[1])
+            dim = (r1 - r0, dim[1])
+
+            def read(names, pt, dtype):
+                return [np.reshape(np.frombuffer(c, dtype=dtype), dim)[:, c0:c1]
+                        for c in in_file.channels(names, pt, dw.min.y + r0, dw.min.y + r1 - 1)]
+
+            if len(header['channels']) == 1:  # Gray scan saved with single_channel=True
+                names = list(header['channels'])
                 d = None
-            elif len(in_file.header()['channels']) >= 4:  # Sim
-                r = in_file.channel('color.R', pt)
-                g = in_file.channel('color.G', pt)
-                b = in_file.channel('color.B', pt)
+            elif len(header['channels']) == 3:  # Scan
+                names = ["G"] if single_channel else ["R", "G", "B"]
+                d = None
+            elif len(header['channels']) >= 4:  # Sim
+                names = ["color.R", "color.G", "color.B"]
 
                 if load_depth:
-                    d = in_file.channel("distance.Y", pt)
-                    d = np.reshape(np.frombuffer(d, dtype=np.float32), dim)
+                    d = read(["distance.Y"], Imath.PixelType(Imath.PixelType.FLOAT), np.float32)[0]
                 else:
                     d = None
 
-            r = np.reshape(np.frombuffer(r, dtype=np.float32), dim)
-            g = np.reshape(np.frombuffer(g, dtype=np.float32), dim)
-            b = np.reshape(np.frombuffer(b, dtype=np.float32), dim)
-            rgb = np.stack([r, g, b], axis=2)
+            half = half and all(header['channels'][name].type.v == Imath.PixelType.HALF for name in names)
+            pt = Imath.PixelType(Imath.PixelType.HALF if half else Imath.PixelType.FLOAT)
+            channels = read(names, pt, np.float16 if half else np.float32)
+            if len(channels) == 1:
+                ret = channels[0].copy()  # frombuffer is read-only
+                if not (make_gray or single_channel):
+                    ret = np.repeat(ret[:, :, None], 3, axis=2)  # RGB, as for the 3 channel layout
+            else:
+                rgb = np.stack(channels, axis=2)
+                if make_gray or single_channel:
+                    ret = cv2.cvtColor(rgb.astype(np.float32, copy=False), cv2.COLOR_RGB2GRAY).astype(rgb.dtype, copy=False)
+                else:
+                    ret = rgb
 
-            ret = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY) if make_gray else rgb
             if load_depth:
                 return ret, d
             else:
@@ -223,6 +339,31 @@ def load_openexr(filename, make_gray=True, load_depth=False):
             in_file.close()
 
 
+# RGB (as load_openexr(..., make_gray=False)) and gray (as load_openexr(..., single_channel=True)) versions of an EXR
+# from a single read, plus its depth if load_depth (None for scans). For frames that are needed both ways
+def load_openexr_rgb_gray(filename, load_depth=False):
+    if load_depth:
+        rgb, depth = load_openexr(filename, make_gray=False, load_depth=True)
+    else:
+        rgb, depth = load_openexr(filename, make_gray=False), None
+
+    with open(filename, "rb") as f:
+        exr = OpenEXR.InputFile(f)
+        try:
+            num_channels = len(exr.header()["channels"])
+        finally:
+            exr.close()
+
+    if num_channels == 1:
+        gray = rgb[:, :, 0].copy()
+    elif num_channels == 3:
+        gray = rgb[:, :, 1].copy()  # single_channel reads G only
+    else:
+        gray = cv2.cvtColor(rgb.astype(np.float32, copy=False), cv2.COLOR_RGB2GRAY).astype(rgb.dtype, copy=False)
+
+    return rgb, gray, depth
+
+
 # Unaffected by default
 def save_ldr(filename, image, ensure_rgb=False):
     if len(image.shape) == 2 and ensure_rgb:
@@ -235,6 +376,7 @@ def save_ldr(filename, image, ensure_rgb=False):
 
 
 # Unaffected by default
+@cached_images
 def load_ldr(filename, make_gray=False):
     img = cv2.imread(filename)[:, :, ::-1]  # BGR by default
 
@@ -244,6 +386,38 @@ def load_ldr(filename, make_gray=False):
     return img
 
 
+# cv2.undistort rebuilds the undistortion maps on every call. Keep the maps of the last few calibrations and image
+# sizes around instead (per process) and only cv2.remap each image, which gives the same result
+_undistort_maps = {}
+
+
+def get_undistort_maps(calib, shape, max_cached=2):
+    key = (tuple(shape[:2]),) + tuple(np.asarray(calib[k], dtype=np.float64).tobytes() for k in ["mtx", "dist", "new_mtx"])
+
+    if key not in _undistort_maps:
+        if len(_undistort_maps) >= max_cached:
+            _undistort_maps.clear()
+        _undistort_maps[key] = cv2.initUndistortRectifyMap(calib["mtx"], calib["dist"], None, calib["new_mtx"],
+                                                           (shape[1], shape[0]), cv2.CV_16SC2)
+    return _undistort_maps[key]
+
+
+def undistort_image(img, calib):
+    map1, map2 = get_undistort_maps(calib, img.shape)
+    return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+
+# Intrinsics for a strided view img[::stride, ::stride] (scale = 1 / stride). Pixel x of the view is pixel
+# stride * x of the full image, so focal lengths and principal point scale while distortion stays the same
+def scale_calibration(calib, scale):
+    calib = dict(calib)
+    for k in ["mtx", "new_mtx"]:
+        if k in calib:
+            calib[k] = np.array(calib[k], dtype=np.float64)
+            calib[k][:2, :] *= scale
+    return calib
+
+
 def load_calibration(filename):
     with open(filename, "r") as f:
         return numpinize(json.load(f))